@@ -0,0 +1,197 @@
+"""
+Engine for running many independent searches, e.g. for data mining.
+
+Cells are fanned out across a process pool. Each completed cell's rows are
+appended to the output as soon as it finishes and the cell is recorded in a
+checkpoint file, with the size of the output so far, so an interrupted run
+can be resumed without repeating work or duplicating rows.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.db import connections
+from pandas import read_csv
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pyarrow = pq = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class CsvWriter(object):
+    """
+    Args:
+        columns (list): Output columns, which every cell's rows are aligned
+            to. Defaults to the header of an existing output, or else the
+            columns of the first cell written
+    """
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.columns = columns
+
+    def reset(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def position(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def truncate(self, position):
+        """
+        Discard rows written after the last checkpoint, e.g. by a cell whose
+        completion wasn't recorded before a crash
+        """
+        if position is not None and self.position() > position:
+            with open(self.path, 'r+') as f:
+                f.truncate(position)
+
+    def write(self, rows, cell):
+        write_header = self.position() == 0
+
+        if self.columns is None:
+            self.columns = list(rows.columns) if write_header else \
+                list(read_csv(self.path, nrows=0).columns)
+
+        dropped_columns = [column for column in rows.columns if column not in self.columns]
+        if dropped_columns:
+            logger.warning('Columns not in the output dropped: {}'.format(
+                ', '.join(dropped_columns)))
+
+        with open(self.path, 'a') as f:
+            rows.reindex(columns=self.columns).to_csv(f, header=write_header, index=False)
+
+
+class ParquetWriter(object):
+    """
+    Write each cell as its own file within a hive-style partitioned dataset
+    (e.g. city=London/duration=3/), readable with pyarrow or pandas. Files are
+    named after the cell, so a cell rerun after a crash overwrites its file.
+    """
+    def __init__(self, path, partition_columns):
+        self.path = path
+        self.partition_columns = partition_columns
+
+    def reset(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    def position(self):
+        return None
+
+    def truncate(self, position):
+        pass  # A cell rerun after a crash overwrites its file
+
+    def write(self, rows, cell):
+        directory = os.path.join(self.path, *[
+            '{}={}'.format(column, rows[column].iloc[0]) for column in self.partition_columns])
+        os.makedirs(directory, exist_ok=True)
+
+        filename = hashlib.sha1(BatchEngine.cell_id(cell).encode('utf-8')).hexdigest()
+        table = pyarrow.Table.from_pandas(
+            rows.drop(self.partition_columns, axis=1), preserve_index=False)
+        pq.write_table(table, os.path.join(directory, filename + '.parquet'))
+
+
+class BatchEngine(object):
+    """
+    Args:
+        run_cell (callable): Takes a cell and returns a DataFrame of rows to
+            output. Must be a module-level function so it can be pickled
+        writer: Object with reset(), write(rows, cell), position() and
+            truncate(position) methods
+        checkpoint_path (str)
+        workers (int): Processes to run; 1 runs cells in this process
+    """
+    def __init__(self, run_cell, writer, checkpoint_path, workers=1):
+        self.run_cell = run_cell
+        self.writer = writer
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+
+    @staticmethod
+    def cell_id(cell):
+        return json.dumps(cell, sort_keys=True, default=str)
+
+    def read_checkpoint(self):
+        """
+        Returns:
+            tuple: (set of completed cell ids, writer position after the last
+            of them, or None if unknown)
+        """
+        completed_cell_ids = set()
+        position = 0  # Anything written before the first checkpoint is incomplete
+
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                for line in f:
+                    # Cell ids are JSON, so never contain a literal tab
+                    cell_id, _, line_position = line.rstrip('\n').partition('\t')
+                    completed_cell_ids.add(cell_id)
+                    position = json.loads(line_position) if line_position else None
+
+        return completed_cell_ids, position
+
+    def record_completion(self, cell, rows):
+        if len(rows) > 0:
+            self.writer.write(rows, cell)
+
+        # Checkpoint only once the rows are safely written
+        with open(self.checkpoint_path, 'a') as f:
+            f.write('{}\t{}\n'.format(self.cell_id(cell), json.dumps(self.writer.position())))
+
+    def run(self, cells, resume=False):
+        """
+        Returns:
+            int: Number of cells that failed (to be retried on resume)
+        """
+        if resume:
+            completed_cell_ids, position = self.read_checkpoint()
+            self.writer.truncate(position)
+        else:
+            completed_cell_ids = set()
+            self.writer.reset()
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+
+        pending_cells = [cell for cell in cells if self.cell_id(cell) not in completed_cell_ids]
+        logger.warning('{} cells to run, {} already complete'.format(
+            len(pending_cells), len(cells) - len(pending_cells)))
+
+        failure_count = 0
+
+        if self.workers == 1:
+            for cell in pending_cells:
+                try:
+                    rows = self.run_cell(cell)
+                except Exception:
+                    logger.exception('Cell failed: {}'.format(self.cell_id(cell)))
+                    failure_count += 1
+                    continue
+                self.record_completion(cell, rows)
+            return failure_count
+
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.run_cell, cell): cell for cell in pending_cells}
+
+            for future in as_completed(futures):
+                cell = futures[future]
+                try:
+                    rows = future.result()
+                except Exception:
+                    logger.exception('Cell failed: {}'.format(self.cell_id(cell)))
+                    failure_count += 1
+                    continue
+                self.record_completion(cell, rows)
+
+        return failure_count
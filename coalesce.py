@@ -0,0 +1,209 @@
+"""
+Sharing of result sets between identical searches.
+
+Completed result sets are reused by anyone searching for the same criteria
+within SHARED_RESULT_CACHE_TTL seconds. While a search is being computed,
+identical searches register as waiters instead of computing again; the worker
+holding the in-flight lock replies to every waiter once it has finished.
+
+The lock is short-lived and kept alive by a heartbeat while the search runs,
+so if its worker dies (e.g. killed for running out of memory) the lock soon
+lapses, and the worker pool re-runs the searches of the orphaned waiters
+(see rescue_orphaned_waiters).
+"""
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from redis.exceptions import WatchError
+
+from apps.search import scheduling, store
+
+
+logger = logging.getLogger(__name__)
+
+FRESH_PREFIX = 'search:fresh:'
+IN_FLIGHT_PREFIX = 'search:in-flight:'
+WAITERS_PREFIX = 'search:waiters:'
+WAITING_KEY = 'search:waiting'  # Result keys with waiters
+
+# In-flight lock heartbeats of this process, keyed by result key
+heartbeats = {}
+
+
+def get_shared_result_cache_ttl():
+    return getattr(settings, 'SHARED_RESULT_CACHE_TTL', 300)
+
+
+def get_in_flight_ttl():
+    # Upper bound on a single search, after which a hung search's lock lapses
+    return getattr(settings, 'SEARCH_IN_FLIGHT_TTL', 180)
+
+
+def get_lock_ttl():
+    # How soon the lock of a worker that died lapses
+    return getattr(settings, 'SEARCH_IN_FLIGHT_LOCK_TTL', 15)
+
+
+def keep_alive(result_key, stop):
+    connection = settings.REDIS_CONNECTION
+    lock_ttl = get_lock_ttl()
+    expires_at = time.time() + get_in_flight_ttl()
+
+    while not stop.wait(lock_ttl / 3) and time.time() < expires_at:
+        connection.expire(IN_FLIGHT_PREFIX + result_key, lock_ttl)
+
+
+def get_cached_stays(result_key):
+    """
+    Returns:
+        DataFrame, or None if no fresh result set is available
+    """
+    connection = settings.REDIS_CONNECTION
+
+    if not connection.exists(FRESH_PREFIX + result_key):
+        return None
+
+    stays = store.load_stays(result_key)
+
+    if stays is not None:
+        # The new session pointer may outlive the stored result set otherwise
+        store.touch(result_key)
+        logger.info('Shared result set reused for {}'.format(result_key))
+
+    return stays
+
+
+def cache_stays(result_key, stays):
+    """
+    Returns:
+        str: Generation of the stored result set (see store.save_stays)
+    """
+    generation = store.save_stays(result_key, stays)
+    settings.REDIS_CONNECTION.setex(FRESH_PREFIX + result_key, get_shared_result_cache_ttl(), 1)
+
+    return generation
+
+
+def expire(result_key):
+    """
+    Stop reusing a result set, so the next identical search is computed again
+    """
+    settings.REDIS_CONNECTION.delete(FRESH_PREFIX + result_key)
+
+
+def acquire(result_key):
+    """
+    Returns:
+        bool: True if the caller should compute the search, False if an
+        identical search is already in flight
+    """
+    if not settings.REDIS_CONNECTION.set(
+            IN_FLIGHT_PREFIX + result_key, 1, nx=True, ex=get_lock_ttl()):
+        return False
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=keep_alive, args=(result_key, stop), daemon=True)
+    heartbeat.start()
+    heartbeats[result_key] = stop
+
+    return True
+
+
+def add_waiter(result_key, criteria, session_key, reply_channel, options):
+    """
+    Register for the reply of an in-flight search. Options are the waiter's
+    own presentation options (see tasks.get_reply_options), and criteria
+    those of its job, for the search to be re-run if nobody replies.
+
+    Returns:
+        bool: True if the in-flight search will reply, False if it finished
+        before registration completed (in which case the caller should use the
+        cached result set or compute the search itself)
+    """
+    connection = settings.REDIS_CONNECTION
+    waiters_key = WAITERS_PREFIX + result_key
+    waiter = json.dumps([session_key, reply_channel, options, criteria])
+
+    pipeline = connection.pipeline()
+    pipeline.rpush(waiters_key, waiter)
+    pipeline.expire(waiters_key, get_in_flight_ttl())
+    pipeline.sadd(WAITING_KEY, result_key)
+    pipeline.execute()
+
+    if connection.exists(IN_FLIGHT_PREFIX + result_key):
+        return True
+
+    # The lock was released between our checks. If our entry is still in the
+    # list then it wasn't collected by release() and nobody will reply
+    return connection.lrem(waiters_key, 1, waiter) == 0
+
+
+def has_waiters(result_key):
+    return settings.REDIS_CONNECTION.llen(WAITERS_PREFIX + result_key) > 0
+
+
+def release(result_key):
+    """
+    Release the in-flight lock and collect anyone waiting on the result.
+
+    Returns:
+        list: (session_key, reply_channel, options) tuples
+    """
+    stop = heartbeats.pop(result_key, None)
+    if stop is not None:
+        stop.set()
+
+    pipeline = settings.REDIS_CONNECTION.pipeline()
+    pipeline.delete(IN_FLIGHT_PREFIX + result_key)
+    collect_waiters(pipeline, result_key)
+    _, waiters, _, _ = pipeline.execute()
+
+    return [tuple(json.loads(waiter.decode('utf-8'))[:3]) for waiter in waiters]
+
+
+def collect_waiters(pipeline, result_key):
+    waiters_key = WAITERS_PREFIX + result_key
+    pipeline.lrange(waiters_key, 0, -1)
+    pipeline.delete(waiters_key)
+    pipeline.srem(WAITING_KEY, result_key)
+
+
+def rescue_orphaned_waiters(function):
+    """
+    Re-run the searches of waiters whose in-flight search has lost its lock
+    without replying, as its worker died. Each waiter's job keeps its search
+    id and deadline, so it is still dropped if superseded or too late.
+
+    Returns:
+        int: Number of searches re-run
+    """
+    connection = settings.REDIS_CONNECTION
+    rescued_count = 0
+
+    for result_key in connection.smembers(WAITING_KEY):
+        result_key = result_key.decode('utf-8')
+        lock_key = IN_FLIGHT_PREFIX + result_key
+
+        # Collected only if the lock is still missing when collecting
+        with connection.pipeline() as pipeline:
+            try:
+                pipeline.watch(lock_key)
+                if pipeline.exists(lock_key):
+                    continue
+                pipeline.multi()
+                collect_waiters(pipeline, result_key)
+                waiters, _, _ = pipeline.execute()
+            except WatchError:
+                continue
+
+        for waiter in waiters:
+            session_key, reply_channel, _, criteria = json.loads(waiter.decode('utf-8'))
+            logger.warning('Re-running search {} for {}, as nobody replied'.format(
+                criteria['search_id'], result_key))
+            if scheduling.requeue(function, criteria, session_key, reply_channel):
+                rescued_count += 1
+
+    return rescued_count
@@ -3,15 +3,19 @@ import logging
 
 from django.conf import settings
 
-from rq import Queue
 from channels.handler import AsgiRequest
-from channels.sessions import channel_and_http_session
+from channels.sessions import channel_and_http_session, channel_session
 
-from apps.search import tasks
+from apps.search import encoding, prefetch, scheduling, tasks
 
 
 logger = logging.getLogger(__name__)
 
+# Clients opt in to streamed results by sending {"protocol": 2} with a search,
+# or to paginated results with {"protocol": 3}, and to a compact wire format
+# with e.g. {"format": "msgpack"}
+SUPPORTED_PROTOCOLS = [1, 2, 3]
+
 
 @channel_and_http_session
 def ws_connect(message):
@@ -20,7 +24,11 @@ def ws_connect(message):
     message.channel_session['session_key'] = session_key
 
     message.reply_channel.send({
-        "text": json.dumps({"status": "connected"})
+        "text": json.dumps({
+            "status": "connected",
+            "protocols": SUPPORTED_PROTOCOLS,
+            "formats": encoding.WIRE_FORMATS,
+        })
     })
 
 
@@ -32,15 +40,31 @@ def ws_receive(message):  # pragma: no cover
         logger.debug("ws message isn't json text=%s", message['text'])
         return
 
-    if criteria['action'] == 'search':
-        queue = Queue(criteria['currency'], connection=settings.REDIS_CONNECTION)
+    # Further actions carry the search criteria and are answered from the
+    # stored search: 'refine' with new filters or sort order (see refinement),
+    # and 'page' or 'filter' with a page of results (see pagination). Each
+    # only supersedes the client's previous request in its group, so a page
+    # request never cancels the search still streaming its results
+    actions = {
+        'search': (tasks.execute_search, scheduling.SEARCH_GROUP),
+        'refine': (tasks.refine_search, 'refine'),
+        'page': (tasks.page_results, 'page'),
+        'filter': (tasks.page_results, 'page'),
+    }
 
+    if criteria['action'] in actions:
         # source_market checked/set already in Results view but get used for tests
         criteria['source_market'] = message.http_session.get('source_market', 'UK')
+        criteria['protocol'] = min(int(criteria.get('protocol', 1)), max(SUPPORTED_PROTOCOLS))
         session_key = message.channel_session['session_key']
         reply_channel = message.reply_channel.name
 
-        queue.enqueue(
-            tasks.execute_search,
-            args=(criteria, session_key, reply_channel),
-        )
+        function, group = actions[criteria['action']]
+        scheduling.enqueue(function, criteria, session_key, reply_channel, group)
+
+
+@channel_session
+def ws_disconnect(message):  # pragma: no cover
+    # Stop work on results that can no longer be delivered
+    scheduling.cancel_client_searches(message.reply_channel.name)
+    prefetch.cancel_client_prefetches(message.reply_channel.name)
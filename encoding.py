@@ -0,0 +1,117 @@
+"""
+Wire formats for the stays sent to the results page, negotiated by the
+websocket client with its search:
+
+records: JSON string of one object per stay (the original format)
+columns: one array per field, with repetitive fields dictionary-encoded
+msgpack: the columns format, with the whole message sent as a binary frame
+
+Columns are converted directly from the frame, following the rules of the
+pandas JSON serialiser used for records, so decoded values are the same
+whichever format is used.
+"""
+import json
+
+import msgpack
+import numpy as np
+from pandas import Series, api, to_datetime
+
+
+WIRE_FORMATS = ['records', 'columns', 'msgpack']
+
+# Decimal places of floats, as pandas' to_json default
+DOUBLE_PRECISION = 10
+
+# Fields with few distinct values relative to the number of stays
+DICTIONARY_ENCODED_FIELDS = [
+    'hotel_1_id',
+    'hotel_2_id',
+    'check_in_1',
+    'check_in_2',
+    'primary_star_rating',
+    'min_review_tier',
+    'primary_review_tier',
+]
+
+
+def dictionary_encode(values):
+    """
+    Returns:
+        tuple: (distinct values in order of first appearance, list of codes)
+    """
+    positions = {}
+    codes = [positions.setdefault(value, len(positions)) for value in values]
+    return sorted(positions, key=positions.get), codes
+
+
+def get_column_values(series):
+    """
+    Returns:
+        list: Values as to_json encodes them: dates as epoch milliseconds,
+        floats rounded to DOUBLE_PRECISION places and missing values as None
+    """
+    if api.types.is_categorical_dtype(series):
+        series = Series(np.asarray(series), index=series.index)
+
+    if series.dtype == object and \
+            api.types.infer_dtype(series.dropna()) in ('datetime', 'datetime64', 'date'):
+        series = to_datetime(series)
+
+    missing = series.isnull().values
+
+    if api.types.is_datetime64_any_dtype(series):
+        values = series.values.astype('datetime64[ms]').astype(np.int64).tolist()
+    elif api.types.is_float_dtype(series):
+        values = series.round(DOUBLE_PRECISION).tolist()
+    else:
+        values = series.tolist()
+
+    if missing.any():
+        values = [None if is_missing else value for value, is_missing in zip(values, missing)]
+
+    return values
+
+
+def encode_stays(results, wire_format):
+    """
+    Args:
+        results (DataFrame): Stays with only the fields required on the page
+        wire_format (str): One of WIRE_FORMATS
+
+    Returns:
+        str for records, otherwise a dict of the form
+        {'columns': [...], 'values': {field: [...]}, 'dictionaries': {field: [...]}}
+        where values of dictionary-encoded fields are indexes into their
+        dictionary
+    """
+    if wire_format == 'records':
+        return results.to_json(orient='records')
+
+    columns = [str(column) for column in results.columns]
+
+    encoded = {
+        'columns': columns,
+        'values': {},
+        'dictionaries': {},
+    }
+
+    for position, column in enumerate(columns):
+        values = get_column_values(results.iloc[:, position])
+
+        if column in DICTIONARY_ENCODED_FIELDS:
+            encoded['dictionaries'][column], encoded['values'][column] = dictionary_encode(values)
+        else:
+            encoded['values'][column] = values
+
+    return encoded
+
+
+def pack_message(message, wire_format):
+    """
+    Returns:
+        dict: Channel message content, with a binary frame for msgpack
+    """
+    if wire_format == 'msgpack':
+        return {"bytes": msgpack.packb(message, use_bin_type=True)}
+
+    return {"text": json.dumps(message)}
@@ -1,76 +1,308 @@
 from datetime import date  # NOQA - used when specifying check-in date manually
 from django.conf import settings
+from functools import partial
 import logging
-import os
-from pandas import datetime
+from pandas import Index, concat
 
 import apps.apis.datafeeds as datafeeds
 import apps.algorithm.switch_preparation as switch
 import apps.algorithm.core as algorithm
 import apps.algorithm.prepare_outputs as outputs
 import apps.algorithm.filter_and_sort as filter_and_sort
+from apps.search import geo, schema
+from apps.search.hotel_cards import hotel_card_cache
+from apps.search.profiling import SearchProfile
+from apps.search.rate_cache import rate_cache
+from apps.search.scheduling import SearchCancelled
+from apps.search.tuning import density_table
 from apps.search.utils import log_size
 
 
 logger = logging.getLogger(__name__)
 
+FILTER_PARAMETERS = {
+    'sample_rate': 2,
+    'min_saving': -25,
+    'min_saving_percentage': -0.05,
+    'max_upgrade_cost': 50,
+    'max_upgrade_cost_percentage': 0.5,
+}
+
+# Column identifying the hotel of each rate, used to partition chunked searches
+RATE_HOTEL_ID_COLUMN = 'hotel_id'
+
+
+def search(criteria, supplier=None, display_all_columns=False, is_cancelled=None,
+           filter_parameters=None):
+    """
+    Args:
+        is_cancelled (callable): Checked between the expensive stages; if it
+            returns True the search is abandoned by raising SearchCancelled
+        filter_parameters (dict): Defaults to FILTER_PARAMETERS
+    """
+    rates, stays, _ = search_with_candidates(
+        criteria, supplier, display_all_columns, is_cancelled, filter_parameters)
+
+    return rates, stays
+
+
+def search_with_candidates(criteria, supplier=None, display_all_columns=False,
+                           is_cancelled=None, filter_parameters=None):
+    """
+    As search, but also returning the rates and unfiltered stays, so that the
+    search can be refined with other filters or sort orders (see refinement).
+
+    Returns:
+        tuple: (rates, stays, candidates), where candidates is a (rates,
+        stays) tuple, or None if they aren't kept
+    """
+    profile = SearchProfile(criteria)
+    check_cancelled = get_cancellation_check(is_cancelled)
+
+    try:
+        rates, stays, filtered = build_candidates(
+            criteria, supplier, profile, check_cancelled, filter_parameters)
+        candidates = get_candidates(rates, stays, filtered)
+
+        rates, stays = finalise(
+            criteria, rates, stays, profile, check_cancelled, filter_parameters,
+            display_all_columns=display_all_columns, filtered=filtered)
+    finally:
+        profile.emit()
+
+    return rates, stays, candidates
+
+
+def get_candidates(rates, stays, filtered):
+    """
+    Returns:
+        tuple: (rates, stays) to keep for refinement, or None if they are
+        already filtered, too large or not kept (SEARCH_KEEP_CANDIDATES)
+    """
+    if not getattr(settings, 'SEARCH_KEEP_CANDIDATES', True):
+        return None
+
+    if filtered:
+        logger.info('Stays constructed in chunks are filtered, so not kept for refinement')
+        return None
+
+    max_rows = getattr(settings, 'SEARCH_CANDIDATE_MAX_ROWS', 2000000)
+    if len(rates) + len(stays) > max_rows:
+        logger.info('{} rates and {} stays are too many to keep for refinement'.format(
+            len(rates), len(stays)))
+        return None
+
+    # Shallow copies, so that columns added or dropped by the final stages
+    # don't change the candidates
+    return rates.copy(deep=False), stays.copy(deep=False)
+
+
+def get_cancellation_check(is_cancelled):
+    def check_cancelled(stage):
+        if is_cancelled is not None and is_cancelled():
+            logger.info('Search cancelled before {}'.format(stage))
+            raise SearchCancelled
+
+    return check_cancelled
+
+
+def restrict_to_switch_candidates(entire_stay_costs, max_switch_distance_in_km):
+    """
+    Drop the entire stay costs of hotels with no other hotel within the
+    maximum switch distance, as they can't be part of any switch (see
+    geo.HotelGrid.has_neighbour_within). This mostly helps sparse areas; in
+    dense cities nearly every hotel has a neighbour. Hotels without
+    coordinates are kept.
+
+    Returns:
+        DataFrame: Entire stay costs for construct_switches
+    """
+    if RATE_HOTEL_ID_COLUMN not in entire_stay_costs.columns or len(entire_stay_costs) == 0:
+        return entire_stay_costs
+
+    hotel_ids = Index(entire_stay_costs[RATE_HOTEL_ID_COLUMN].dropna().unique())
+    hotels = hotel_card_cache.get_coordinates(hotel_ids).dropna()
+    has_neighbour = geo.HotelGrid(hotels).has_neighbour_within(max_switch_distance_in_km)
+
+    paired_hotel_ids = has_neighbour.index[has_neighbour.values]
+    unlocated_hotel_ids = hotel_ids.difference(hotels['hotel_id'])
+    candidate_hotel_ids = paired_hotel_ids.union(unlocated_hotel_ids)
+
+    logger.info('{} of {} hotels have another hotel within {}km'.format(
+        len(paired_hotel_ids), len(hotel_ids), max_switch_distance_in_km))
+
+    return entire_stay_costs[entire_stay_costs[RATE_HOTEL_ID_COLUMN].isin(candidate_hotel_ids)]
 
-def search(criteria, supplier=None, display_all_columns=False):
-    night_count = len(criteria['check_in_range'])
+
+def build_candidates(criteria, supplier, profile, check_cancelled, filter_parameters=None):
+    """
+    Fetch rates and construct benchmarked stays: everything which doesn't
+    depend on the filter parameters or sort order.
+
+    Returns:
+        tuple: (rates, stays, filtered), where filtered is True if stays were
+        constructed in chunks and so have already been filtered
+    """
+    if filter_parameters is None:
+        filter_parameters = FILTER_PARAMETERS
 
     if supplier is None:  # pragma: no cover
         supplier = settings.DEFAULT_SUPPLIER
     get_rates = getattr(datafeeds, 'get_' + supplier + '_rates')
 
-    rates, entire_stay_costs = get_rates(criteria)
+    # Batch searches over overlapping windows share one fetch per place
+    if criteria.get('reuse_rates'):  # pragma: no cover
+        get_rates = partial(rate_cache.get_rates, get_rates)
+
+    rates, entire_stay_costs = profile.run('get_rates', get_rates, criteria)
+    rates = conform(rates, 'get_rates')
+    entire_stay_costs = conform(entire_stay_costs, 'get_rates')
     log_size(rates, 'rates')
     log_size(entire_stay_costs, 'entire_stay_costs')
 
-    rates = datafeeds.filter_out_unmapped_hotels(rates)
-
-    max_switch_distance_in_km = settings.MAX_SWITCH_DISTANCE_IN_KM
-    max_review_tier_decrease = settings.MAX_REVIEW_TIER_DECREASE
+    rates = profile.run(
+        'filter_out_unmapped_hotels', datafeeds.filter_out_unmapped_hotels, rates)
 
-    # Paris is the largest city by number of hotels. While the default settings
-    # work well for other cities, Paris requires some overrides
-    if 2 < float(criteria['longitude']) < 2.6 \
-            and 48.8 < float(criteria['latitude']) < 50:  # pragma: no cover
-        logger.info('PARIS EXCEPTION APPLIED')
-        max_switch_distance_in_km = int(os.getenv('PARIS_MAX_SWITCH_DISTANCE_IN_KM', 2))
-        max_review_tier_decrease = int(os.getenv('PARIS_MAX_REVIEW_TIER_DECREASE', 0))
+    max_switch_distance_in_km, max_review_tier_decrease = density_table.get_limits(
+        criteria['latitude'], criteria['longitude'])
 
-    start_time = datetime.now()
-    switches = switch.construct_switches(
-        criteria, entire_stay_costs, max_switch_distance_in_km, max_review_tier_decrease)
+    switch_stay_costs = profile.run(
+        'restrict_to_switch_candidates', restrict_to_switch_candidates,
+        entire_stay_costs, max_switch_distance_in_km)
 
-    end_time = datetime.now()
-    elapsed_time = end_time - start_time
-    logger.info('Switch construction took {}s'.format(elapsed_time))
+    check_cancelled('construct_switches')
+    switches = profile.run(
+        'construct_switches', switch.construct_switches,
+        criteria, switch_stay_costs, max_switch_distance_in_km, max_review_tier_decrease)
+    switches = conform(switches, 'construct_switches')
     log_size(switches, 'switches')
-    stays = algorithm.construct_stays(rates, criteria['check_in_range'], switches)
+
+    chunk_hotel_count = getattr(settings, 'STAY_CHUNK_HOTEL_COUNT', None)
+
+    if chunk_hotel_count and len(rates) > 0:
+        stays = profile.run(
+            'construct_stays_in_chunks', construct_stays_in_chunks,
+            rates, criteria['check_in_range'], switches, chunk_hotel_count, check_cancelled,
+            filter_parameters)
+        return rates, stays, True
+
+    check_cancelled('construct_stays')
+    stays = profile.run(
+        'construct_stays', algorithm.construct_stays,
+        rates, criteria['check_in_range'], switches)
+    stays = conform(stays, 'construct_stays')
     log_size(stays, 'initial stays')
 
-    stays = outputs.add_metadata_to_stays(stays)
+    check_cancelled('add_metadata_to_stays')
+    stays = profile.run('add_metadata_to_stays', outputs.add_metadata_to_stays, stays)
+    stays = conform(stays, 'add_metadata_to_stays')
+
+    stays = profile.run('add_benchmark_to_stays', outputs.add_benchmark_to_stays, stays)
+    stays = conform(stays, 'add_benchmark_to_stays')
+
+    return rates, stays, False
+
+
+def finalise(criteria, rates, stays, profile, check_cancelled, filter_parameters=None,
+             sort=None, display_all_columns=False, filtered=False):
+    """
+    Filter and sort candidate stays into results. Cheap relative to
+    build_candidates, so it can be repeated with other parameters.
+
+    Args:
+        sort (tuple): Optional (column, ascending) applied after the default
+            sort, which breaks ties
+
+    Returns:
+        tuple: (rates, stays)
+    """
+    night_count = len(criteria['check_in_range'])
 
-    stays = outputs.add_benchmark_to_stays(stays)
+    if filter_parameters is None:
+        filter_parameters = FILTER_PARAMETERS
 
-    stays = filter_and_sort.filter_stays(
-        stays, sample_rate=2, min_saving=-25, min_saving_percentage=-0.05,
-        max_upgrade_cost=50, max_upgrade_cost_percentage=0.5)
+    if not filtered:
+        stays = profile.run(
+            'filter_stays', filter_and_sort.filter_stays, stays, **filter_parameters)
     log_size(stays, 'filtered stays')
 
-    stays = outputs.add_rate_information_to_stays(stays, rates)
+    check_cancelled('add_rate_information_to_stays')
+    stays = profile.run(
+        'add_rate_information_to_stays', outputs.add_rate_information_to_stays, stays, rates)
+    stays = conform(stays, 'add_rate_information_to_stays')
     log_size(stays, 'filtered stays + rate info')
 
-    stays = filter_and_sort.sort_stays(stays, night_count)
-    stays = outputs.make_hotel_ids_int(stays)
+    stays = profile.run('sort_stays', filter_and_sort.sort_stays, stays, night_count)
+    stays = profile.run('make_hotel_ids_int', outputs.make_hotel_ids_int, stays)
 
     if stays['switch_count'].max() > 0:
-        stays = outputs.add_switching_benefit(stays, criteria['currency'])
+        stays = profile.run(
+            'add_switching_benefit', outputs.add_switching_benefit, stays, criteria['currency'])
 
     if not display_all_columns:  # pragma: no cover
-        stays = outputs.remove_no_longer_required_columns(stays)
+        stays = profile.run(
+            'remove_no_longer_required_columns', outputs.remove_no_longer_required_columns, stays)
 
-    stays = outputs.round_data(stays)
+    if sort is not None:
+        column, ascending = sort
+        stays = stays.sort_values(column, ascending=ascending, kind='mergesort')
+
+    # Rounding after restoring float64 costs, so values are exact when serialised
+    if getattr(settings, 'COMPACT_STAY_DTYPES', False):
+        stays = schema.to_output(stays)
+        rates = schema.to_output(rates, date_columns=[])
+
+    stays = profile.run('round_data', outputs.round_data, stays)
 
     return rates, stays
+
+
+def conform(frame, stage):
+    """
+    Apply compact dtypes after a stage (see schema), if COMPACT_STAY_DTYPES
+    is set. Opt-in while the algorithm stages are verified with them;
+    COMPACT_STAY_DTYPES_STRICT makes schema violations fail the search.
+    """
+    if getattr(settings, 'COMPACT_STAY_DTYPES', False):
+        return schema.conform(
+            frame, stage, strict=getattr(settings, 'COMPACT_STAY_DTYPES_STRICT', False))
+    return frame
+
+
+def construct_stays_in_chunks(rates, check_in_range, switches, chunk_hotel_count,
+                              check_cancelled, filter_parameters):
+    """
+    Construct, benchmark and filter stays for blocks of chunk_hotel_count
+    first hotels at a time, so that only one block's unfiltered stays are held
+    in memory rather than the whole city's.
+
+    Each block's rates include the second hotels of its switches, as their
+    single hotel stays are needed for benchmarks, but only stays starting at a
+    hotel in the block are kept. This relies on benchmarks and filters being
+    evaluated per stay; rates, switches and stays must share hotel id types.
+
+    Returns:
+        DataFrame: Filtered stays
+    """
+    hotel_ids = rates[RATE_HOTEL_ID_COLUMN].unique()
+    chunks = []
+
+    for start in range(0, len(hotel_ids), chunk_hotel_count):
+        check_cancelled('construct_stays')
+
+        block = hotel_ids[start:start + chunk_hotel_count]
+        block_switches = switches[switches['hotel_1_id'].isin(block)]
+        block_hotel_ids = Index(block).union(Index(block_switches['hotel_2_id'].unique()))
+        block_rates = rates[rates[RATE_HOTEL_ID_COLUMN].isin(block_hotel_ids)]
+
+        stays = algorithm.construct_stays(block_rates, check_in_range, block_switches)
+        stays = conform(stays, 'construct_stays')
+        stays = conform(outputs.add_metadata_to_stays(stays), 'add_metadata_to_stays')
+        stays = conform(outputs.add_benchmark_to_stays(stays), 'add_benchmark_to_stays')
+        stays = stays[stays['hotel_1_id'].isin(block)]
+        stays = filter_and_sort.filter_stays(stays, **filter_parameters)
+
+        logger.debug('Chunk of {} hotels: {} stays kept'.format(len(block), len(stays)))
+        chunks.append(stays)
+
+    return concat(chunks, ignore_index=True)
@@ -0,0 +1,151 @@
+"""
+Spatial indexing of hotels for switch candidate pairing.
+
+Hotels are bucketed into a grid of cells at least max_distance_in_km across,
+so any pair within that distance lies in the same or an adjacent cell.
+Candidate pairs are generated by joining each cell with itself and its
+forward neighbours, then refined with the haversine distance, rather than
+comparing every pair of hotels. In dense areas most pairs of neighbouring
+cells are within range, so the pairs themselves still grow with the square
+of the local density.
+"""
+import numpy as np
+from pandas import DataFrame, Series, concat
+
+
+EARTH_RADIUS_IN_KM = 6371.0088
+KM_PER_DEGREE_OF_LATITUDE = 111.195
+
+# Each unordered pair of neighbouring cells is visited once
+FORWARD_NEIGHBOUR_OFFSETS = [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+
+def haversine_km(latitude_1, longitude_1, latitude_2, longitude_2):
+    """
+    Vectorised great-circle distance. Accepts scalars or arrays in degrees.
+    """
+    latitude_1, longitude_1, latitude_2, longitude_2 = map(
+        np.radians, [latitude_1, longitude_1, latitude_2, longitude_2])
+
+    a = (np.sin((latitude_2 - latitude_1) / 2) ** 2 +
+         np.cos(latitude_1) * np.cos(latitude_2) * np.sin((longitude_2 - longitude_1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_IN_KM * np.arcsin(np.sqrt(a))
+
+
+def get_cells(latitudes, longitudes, cell_size_in_km, reference_latitude):
+    """
+    Returns:
+        tuple: (row, column) arrays of grid cell indexes
+    """
+    latitude_step = cell_size_in_km / KM_PER_DEGREE_OF_LATITUDE
+
+    # Longitude degrees shrink towards the poles. Scale by the cosine of the
+    # latitude furthest from the equator so that cells are never too narrow
+    longitude_step = latitude_step / max(np.cos(np.radians(reference_latitude)), 0.01)
+
+    rows = np.floor(np.asarray(latitudes) / latitude_step).astype(np.int64)
+    columns = np.floor(np.asarray(longitudes) / longitude_step).astype(np.int64)
+
+    return rows, columns
+
+
+class HotelGrid(object):
+    """
+    Args:
+        hotels (DataFrame): hotel_id, latitude and longitude columns
+    """
+    def __init__(self, hotels):
+        self.hotels = hotels[['hotel_id', 'latitude', 'longitude']].dropna().reset_index(drop=True)
+
+    def pairs_within(self, max_distance_in_km):
+        """
+        Returns:
+            DataFrame: hotel_1_id, hotel_2_id and distance_in_km for every
+            unordered pair of distinct hotels within max_distance_in_km
+        """
+        hotels = self.hotels
+        columns = ['hotel_1_id', 'hotel_2_id', 'distance_in_km']
+
+        if len(hotels) < 2:
+            return DataFrame(columns=columns)
+
+        reference_latitude = hotels['latitude'].abs().max()
+        rows, cell_columns = get_cells(
+            hotels['latitude'], hotels['longitude'], max_distance_in_km, reference_latitude)
+        cells = DataFrame({'row': rows, 'column': cell_columns, 'position': hotels.index})
+
+        candidates = []
+        for row_offset, column_offset in FORWARD_NEIGHBOUR_OFFSETS:
+            neighbours = cells.assign(
+                row=cells['row'] - row_offset, column=cells['column'] - column_offset)
+            pairs = cells.merge(neighbours, on=['row', 'column'], suffixes=('_1', '_2'))
+
+            if (row_offset, column_offset) == (0, 0):
+                pairs = pairs[pairs['position_1'] < pairs['position_2']]
+
+            candidates.append(pairs[['position_1', 'position_2']])
+
+        candidates = concat(candidates, ignore_index=True)
+        hotel_1 = hotels.iloc[candidates['position_1'].values]
+        hotel_2 = hotels.iloc[candidates['position_2'].values]
+
+        distances = haversine_km(
+            hotel_1['latitude'].values, hotel_1['longitude'].values,
+            hotel_2['latitude'].values, hotel_2['longitude'].values)
+        within_distance = distances <= max_distance_in_km
+
+        return DataFrame({
+            'hotel_1_id': hotel_1['hotel_id'].values[within_distance],
+            'hotel_2_id': hotel_2['hotel_id'].values[within_distance],
+            'distance_in_km': distances[within_distance],
+        }, columns=columns)
+
+    def has_neighbour_within(self, max_distance_in_km):
+        """
+        Hotels sharing a cell half the distance across are within range of
+        each other without computing any distances, so only the remaining
+        hotels are compared with those in neighbouring cells. In dense areas
+        that is few hotels, unlike generating every pair.
+
+        Returns:
+            Series: True for hotels with another hotel within
+            max_distance_in_km, indexed by hotel_id
+        """
+        hotels = self.hotels
+
+        # Cells are no wider than their height at the latitude nearest the
+        # equator, so two hotels in a cell are at most 1/sqrt(2) of the
+        # distance apart
+        rows, columns = get_cells(
+            hotels['latitude'], hotels['longitude'], max_distance_in_km / 2,
+            hotels['latitude'].abs().min() if len(hotels) > 0 else 0)
+        has_neighbour = DataFrame({'row': rows, 'column': columns}).duplicated(keep=False).values
+
+        remaining = np.flatnonzero(~has_neighbour)
+        if len(remaining) > 0 and len(hotels) > 1:
+            rows, columns = get_cells(
+                hotels['latitude'], hotels['longitude'], max_distance_in_km,
+                hotels['latitude'].abs().max())
+            cells = DataFrame({'row': rows, 'column': columns, 'position': hotels.index})
+
+            candidates = []
+            for row_offset in (-1, 0, 1):
+                for column_offset in (-1, 0, 1):
+                    neighbours = cells.assign(
+                        row=cells['row'] - row_offset, column=cells['column'] - column_offset)
+                    pairs = cells.iloc[remaining].merge(
+                        neighbours, on=['row', 'column'], suffixes=('_1', '_2'))
+                    candidates.append(pairs.loc[
+                        pairs['position_1'] != pairs['position_2'], ['position_1', 'position_2']])
+
+            candidates = concat(candidates, ignore_index=True)
+            hotel_1 = hotels.iloc[candidates['position_1'].values]
+            hotel_2 = hotels.iloc[candidates['position_2'].values]
+
+            distances = haversine_km(
+                hotel_1['latitude'].values, hotel_1['longitude'].values,
+                hotel_2['latitude'].values, hotel_2['longitude'].values)
+            has_neighbour[candidates['position_1'].values[distances <= max_distance_in_km]] = True
+
+        return Series(has_neighbour, index=hotels['hotel_id'].values)
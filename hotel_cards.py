@@ -0,0 +1,152 @@
+"""
+Worker-local cache of the hotel information shown on the results page.
+
+Cards are held as a single DataFrame indexed by hotel_id, so the hotels for a
+result set are a vectorised take rather than an ORM round trip. Workers can
+preload every hotel; otherwise cards are loaded on first use and retained.
+Cards of changed hotels are reloaded individually (see hotel_changes), and
+the whole cache is refreshed when its TTL passes, which also picks up changes
+made without signals, e.g. by bulk updates.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from pandas import DataFrame, Index, concat
+
+from apps.metadata.models import Hotel
+from apps.search import hotel_changes
+
+
+logger = logging.getLogger(__name__)
+
+# Card field to Hotel lookup
+CARD_FIELDS = OrderedDict([
+    ('name', 'name'),
+    ('star_rating', 'star_rating'),
+    ('main_image_url', 'main_image_url'),
+    ('recommendations', 'trustyou__recommendations'),
+    ('summary', 'trustyou__summary'),
+    ('trust_score', 'trustyou__trust_score'),
+    ('trust_score_description', 'trustyou__trust_score_description'),
+    ('review_count', 'trustyou__review_count'),
+    ('category_badge', 'trustyou__category_badge'),
+    ('latitude', 'latitude'),
+    ('longitude', 'longitude'),
+])
+
+
+def load_cards(hotel_ids=None):
+    """
+    Args:
+        hotel_ids (list): Defaults to all hotels
+
+    Returns:
+        DataFrame: Cards indexed by hotel_id
+    """
+    hotels = Hotel.objects.all()
+    if hotel_ids is not None:
+        hotels = hotels.filter(hotel_id__in=hotel_ids)
+
+    cards = DataFrame(
+        list(hotels.values_list('hotel_id', *CARD_FIELDS.values()).iterator()),
+        columns=['hotel_id'] + list(CARD_FIELDS.keys()))
+
+    return cards.set_index('hotel_id')
+
+
+class HotelCardCache(object):
+    def __init__(self):
+        self.cards = None
+        self.complete = False
+
+    def reset(self):
+        _, self.changes_checked_at = hotel_changes.get_changes(None)
+        self.cards = load_cards([])
+        self.complete = False
+        self.loaded_at = time.time()
+
+    def preload(self):
+        self.reset()
+        self.cards = load_cards()
+        self.complete = True
+        logger.info('Preloaded {} hotel cards'.format(len(self.cards)))
+
+    def refresh(self):
+        if self.complete:
+            self.preload()
+        else:
+            self.reset()
+
+    def reload(self, hotel_ids):
+        """
+        Reload the cards of changed hotels, dropping those of deleted hotels.
+        A partial cache only reloads the hotels it holds.
+        """
+        if not self.complete:
+            hotel_ids = self.cards.index.intersection(hotel_ids)
+        if len(hotel_ids) == 0:
+            return
+
+        cards = load_cards(list(hotel_ids))
+        self.cards = concat([self.cards.drop(self.cards.index.intersection(hotel_ids)), cards])
+        logger.info('Reloaded {} changed hotel cards'.format(len(cards)))
+
+    def check_validity(self):
+        ttl = getattr(settings, 'HOTEL_CARD_CACHE_TTL', 3600)
+
+        if self.cards is None:
+            self.reset()
+        elif time.time() - self.loaded_at > ttl:
+            self.refresh()
+        else:
+            changed_hotel_ids, self.changes_checked_at = hotel_changes.get_changes(
+                self.changes_checked_at)
+            if changed_hotel_ids is None:
+                self.refresh()
+            else:
+                self.reload(list(changed_hotel_ids))
+
+    def get_card_frame(self, hotel_ids):
+        """
+        Args:
+            hotel_ids (iterable): Possibly as floats, since hotel id columns
+            containing blanks are stored as floats
+
+        Returns:
+            DataFrame: Cards of the hotels which exist, indexed by hotel_id
+        """
+        self.check_validity()
+
+        hotel_ids = [int(hotel_id) for hotel_id in hotel_ids]
+
+        # Even a preloaded cache may lack hotels created since, or created
+        # without signals (e.g. by bulk_create)
+        missing_hotel_ids = Index(hotel_ids).difference(self.cards.index)
+        if len(missing_hotel_ids) > 0:
+            self.cards = concat([self.cards, load_cards(list(missing_hotel_ids))])
+
+        return self.cards.loc[self.cards.index.intersection(hotel_ids)]
+
+    def get_cards(self, hotel_ids):
+        """
+        Returns:
+            dict: Card dicts keyed by hotel_id (as a string)
+        """
+        cards = self.get_card_frame(hotel_ids)
+        cards.index = cards.index.astype(str)  # String required for use as key
+
+        return cards.to_dict('index')
+
+    def get_coordinates(self, hotel_ids):
+        """
+        Returns:
+            DataFrame: hotel_id, latitude and longitude columns
+        """
+        cards = self.get_card_frame(hotel_ids)
+
+        return cards[['latitude', 'longitude']].rename_axis('hotel_id').reset_index()
+
+
+hotel_card_cache = HotelCardCache()
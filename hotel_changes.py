@@ -0,0 +1,58 @@
+"""
+Log of changed hotels, shared via Redis, so that process-wide caches derived
+from hotels (hotel cards, memoised facility lists) reload or evict only the
+hotels that changed rather than everything. Hotels are recorded by the
+signals with the Redis server's time, so every process compares against the
+same clock, and the log is trimmed to a retention period. A cache which
+hasn't checked for longer than that has to reload everything.
+"""
+from django.conf import settings
+
+
+CHANGES_KEY = 'search:hotel_changes'
+
+# Changes are read from a little before the previous check, as a change may
+# be recorded with a time just before a concurrent check
+OVERLAP_IN_SECONDS = 5
+
+
+def get_retention_in_seconds():
+    return getattr(settings, 'HOTEL_CHANGE_RETENTION_IN_SECONDS', 86400)
+
+
+def get_time():
+    seconds, microseconds = settings.REDIS_CONNECTION.time()
+    return seconds + microseconds / 1e6
+
+
+def record(hotel_ids):
+    hotel_ids = list(hotel_ids)
+    if not hotel_ids:
+        return
+
+    now = get_time()
+
+    pipeline = settings.REDIS_CONNECTION.pipeline()
+    pipeline.zadd(CHANGES_KEY, {str(hotel_id): now for hotel_id in hotel_ids})
+    pipeline.zremrangebyscore(CHANGES_KEY, '-inf', now - get_retention_in_seconds())
+    pipeline.execute()
+
+
+def get_changes(since):
+    """
+    Args:
+        since (float): Time returned by the previous call, or None
+
+    Returns:
+        tuple: (set of hotel ids changed since then, or None if the log no
+        longer covers that period, time to pass to the next call)
+    """
+    now = get_time()
+
+    if since is None or now - since > get_retention_in_seconds() - OVERLAP_IN_SECONDS:
+        return None, now
+
+    hotel_ids = settings.REDIS_CONNECTION.zrangebyscore(
+        CHANGES_KEY, since - OVERLAP_IN_SECONDS, '+inf')
+
+    return {int(hotel_id) for hotel_id in hotel_ids}, now
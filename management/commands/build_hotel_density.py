@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from apps.search import tuning
+
+
+class Command(BaseCommand):
+    help = "Rebuild the hotel density table used to tune switch limits"
+    requires_migrations_checks = True
+
+    def handle(self, *args, **options):
+        limits = tuning.build_density_table()
+        self.stdout.write('{} restricted regions, smallest switch distance {} km'.format(
+            len(limits), min(distance for distance, _ in limits.values()) if limits else '-'))
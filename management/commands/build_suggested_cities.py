@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from apps.search import suggestions
+
+
+class Command(BaseCommand):
+    help = "Rebuild the suggested cities for places with too many hotels to search"
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--if-stale', action='store_true',
+            help='Only rebuild if hotels have changed since the last build')
+
+    def handle(self, *args, **options):
+        if options['if_stale'] and suggestions.get_version() and not suggestions.is_stale():
+            self.stdout.write('Suggested cities are up to date')
+            return
+
+        suggested_cities = suggestions.build()
+        for level in suggestions.LEVELS:
+            self.stdout.write('{}: {} places'.format(level, len(suggested_cities[level])))
@@ -1,9 +1,13 @@
+from collections import defaultdict
 from django.conf import settings
 from django.contrib.sessions.backends.db import SessionStore
 from django.contrib.sessions.models import Session
 from django.core.management.base import BaseCommand
 import logging
 from pandas import datetime
+import time
+
+from apps.search import store
 
 
 logger = logging.getLogger(__name__)
@@ -13,35 +17,91 @@ class Command(BaseCommand):
     help = "Remove expired session results"
     requires_migrations_checks = True
 
-    def remove_expired_session_results(self):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full-scan', action='store_true',
+            help='Also check every session, e.g. for results stored before the expiry index')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000)
+
+    def is_expired_session_result(self, item):
+        # Pointers into the result store, plus any complete result sets
+        # stored in the session before the store was introduced
+        if type(item) != dict:
+            return False
+
+        if sorted(list(item.keys())) not in (['result_key', 'timestamp'],
+                                             ['stays', 'timestamp']):
+            return False
+
+        timestamp = datetime.strptime(item['timestamp'], '%Y-%m-%dT%H:%M:%S')
+        timedelta = datetime.now() - timestamp
+        age_in_seconds = timedelta.total_seconds()
+
+        return age_in_seconds > settings.MAXIMUM_RESULT_AGE_IN_SECONDS
+
+    def remove_from_sessions(self, search_keys_by_session):
+        """
+        Load the affected sessions in one query and write each back once.
+
+        Args:
+            search_keys_by_session (dict): Session key to the search keys to
+                check, or None to check every key in the session
         """
-        We store result sets in the session variable for access from the stay
-        detail view. They are valid for 30 minutes, after which they are purged
-        by a scheduled Heroku call to this command.
+        sessions = Session.objects.filter(session_key__in=list(search_keys_by_session))
+        session_store = SessionStore()
+
+        for session in sessions.iterator():
+            data = session_store.decode(session.session_data)
+            search_keys = search_keys_by_session[session.session_key]
+            if search_keys is None:
+                search_keys = list(data.keys())
+
+            # A pointer may have been refreshed by a repeat search since it was
+            # indexed, so check its own timestamp
+            expired_keys = [
+                key for key in search_keys
+                if key in data and self.is_expired_session_result(data[key])]
+
+            if expired_keys:
+                for key in expired_keys:
+                    del data[key]
+                Session.objects.filter(session_key=session.session_key).update(
+                    session_data=session_store.encode(data))
+
+    def remove_expired_session_results(self, batch_size=1000):
         """
-        maximum_result_age_in_seconds = settings.MAXIMUM_RESULT_AGE_IN_SECONDS
+        We store pointers to result sets in the session variable for access
+        from the stay detail view. They are valid for 30 minutes, after which
+        they are purged by a scheduled Heroku call to this command. The result
+        sets themselves expire from the result store independently.
 
-        session_keys = Session.objects.all().values_list('session_key', flat=True)
+        Each pointer is indexed by expiry time when written, so only sessions
+        with expired pointers are visited.
+        """
+        now = time.time()
 
-        for session_key in session_keys:
-            session = SessionStore(session_key=session_key)
+        while True:
+            session_results = store.get_expired_session_results(now, batch_size)
+            if not session_results:
+                break
 
-            # Each user session may have multiple associated search keys
-            for key in list(session.keys()):
-                item = session[key]
+            search_keys_by_session = defaultdict(list)
+            for session_key, search_key in session_results:
+                search_keys_by_session[session_key].append(search_key)
 
-                # Identify keys associated with search results
-                if type(item) != dict:
-                    continue
+            self.remove_from_sessions(search_keys_by_session)
+            store.remove_session_results_from_index(session_results, now)
 
-                if sorted(list(item.keys())) == ['stays', 'timestamp']:
-                    timestamp = datetime.strptime(item['timestamp'], '%Y-%m-%dT%H:%M:%S')
-                    timedelta = datetime.now() - timestamp
-                    age_in_seconds = timedelta.total_seconds()
+    def remove_all_expired_session_results(self, batch_size=1000):
+        session_keys = list(Session.objects.all().values_list('session_key', flat=True))
 
-                    if age_in_seconds > maximum_result_age_in_seconds:
-                        del session[key]
-                        session.save()
+        for start in range(0, len(session_keys), batch_size):
+            self.remove_from_sessions(
+                {session_key: None for session_key in session_keys[start:start + batch_size]})
 
     def handle(self, *args, **options):
-        self.remove_expired_session_results()
+        self.remove_expired_session_results(options['batch_size'])
+
+        if options['full_scan']:
+            self.remove_all_expired_session_results(options['batch_size'])
@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+import logging
+from multiprocessing import Process
+import signal
+import time
+
+from apps.search import scheduling, worker
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Run a pool of warm search workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'queues', nargs='*',
+            help='Queues to work, in priority order; defaults to every currency queue '
+                 'followed by every low priority queue')
+        parser.add_argument(
+            '--workers', type=int, default=2)
+        parser.add_argument(
+            '--max-jobs', type=int, default=500,
+            help='Jobs each worker runs before being replaced')
+        parser.add_argument(
+            '--shutdown-timeout', type=int, default=60,
+            help='Seconds to wait for workers to finish their current job on shutdown')
+
+    def handle(self, *args, **options):
+        queue_names = options['queues'] or scheduling.get_queue_names()
+
+        worker.preload()
+
+        # Children must open their own database connections
+        connections.close_all()
+
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+        signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+        processes = [None] * options['workers']
+
+        while not stopping:
+            try:
+                worker.rescue_orphaned_waiters()
+            except Exception:
+                logger.exception('Unable to rescue orphaned waiters')
+
+            if any(process is None or not process.is_alive() for process in processes):
+                try:
+                    worker.refresh()
+                except Exception:
+                    logger.exception('Unable to refresh preloaded caches')
+                connections.close_all()
+
+            for slot, process in enumerate(processes):
+                if process is None or not process.is_alive():
+                    process = Process(
+                        target=worker.run_worker, args=(queue_names, options['max_jobs']))
+                    process.start()
+                    processes[slot] = process
+            time.sleep(1)
+
+        # Workers in the same process group have received the signal too, and
+        # RQ workers finish their current job on the first SIGTERM but stop
+        # immediately on a second, so they're only signalled if they haven't
+        # stopped in time (e.g. if just this process was signalled)
+        shutdown_deadline = time.time() + options['shutdown_timeout']
+        for process in processes:
+            process.join(max(0, shutdown_deadline - time.time()))
+
+        for process in processes:
+            if process.is_alive():
+                logger.warning('Terminating search worker {}'.format(process.pid))
+                process.terminate()
+        for process in processes:
+            process.join()
@@ -1,9 +1,14 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+import json
 import logging
-import os
-from pandas import concat, datetime, date_range, DateOffset
+from pandas import DataFrame, concat, datetime, date_range, DateOffset
 
-from apps.search import tasks
+try:
+    import yaml
+except ImportError:  # pragma: no cover
+    yaml = None
+
+from apps.search import batch, tasks
 
 
 logger = logging.getLogger(__name__)
@@ -67,76 +72,209 @@ class Command(BaseCommand):
 
     stay_durations = [3, 4, 5, 6]
 
+    grouping_columns = ['primary_star_rating', 'min_review_tier']
+
+    partition_columns = ['city', 'duration']
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scenarios',
+            help='JSON or YAML file overriding any of base_data, base_check_in, '
+                 'check_in_day_count, stay_durations, grouping_columns and cities')
+        parser.add_argument(
+            '--format', choices=['parquet', 'csv'], default='parquet',
+            help='Parquet output is partitioned by city and duration')
+        parser.add_argument(
+            '--output', default=None,
+            help='Defaults to analysis_output (parquet) or analysis_output.csv')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of processes to run searches in')
+        parser.add_argument(
+            '--checkpoint', default=None,
+            help='Record of completed cells; defaults to the output path + .checkpoint')
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Skip cells completed by a previous run and append to its output')
+        parser.add_argument(
+            '--reuse-rates', action='store_true',
+            help='Fetch rates once per city for the whole check-in span')
+
+    def load_scenarios(self, path):
+        """
+        Returns:
+            dict: Scenario definition, with class attributes as defaults
+        """
+        scenarios = {
+            'base_data': self.base_data,
+            'base_check_in': self.base_check_in.strftime('%Y-%m-%d'),
+            'check_in_day_count': len(self.check_in_range),
+            'stay_durations': self.stay_durations,
+            'grouping_columns': self.grouping_columns,
+            'cities': self.cities,
+        }
+
+        if path is None:
+            return scenarios
+
+        with open(path) as f:
+            if path.endswith(('.yaml', '.yml')):
+                if yaml is None:
+                    raise CommandError('PyYAML is required for YAML scenario files')
+                overrides = yaml.safe_load(f)
+            else:
+                overrides = json.load(f)
+
+        unknown_keys = set(overrides) - set(scenarios)
+        if unknown_keys:
+            raise CommandError('Unknown scenario keys: {}'.format(', '.join(sorted(unknown_keys))))
+
+        base_data = scenarios['base_data'].copy()
+        base_data.update(overrides.pop('base_data', {}))
+        scenarios.update(overrides)
+        scenarios['base_data'] = base_data
+
+        return scenarios
+
     def handle(self, *args, **options):
-        try:
-            os.rename('analysis_output.csv', 'check_file_access.csv')
-            os.rename('check_file_access.csv', 'analysis_output.csv')
-        except OSError:
-            raise Exception('Destination file is still open. Please close before running!')
-
-        all_stays = []
-
-        for city in self.cities:
-            for check_in in self.check_in_range:
-                for duration in self.stay_durations:
-                    check_out = check_in + DateOffset(days=duration)
-                    check_in_range = date_range(check_in, check_out - DateOffset(days=1))
-                    data = self.base_data.copy()
-                    data.update({
-                        'checkIn': check_in,
-                        'checkOut': check_out,
-                        'check_in_range': check_in_range,
-                        'country':  city['country'],
-                        'state':  city['state'],
-                        'city':  city['city'],
-                    })
-
-                    stays = tasks.execute_search(data, '', None)
-                    result_count = len(stays)
-                    if result_count == 0:
-                        continue
-
-                    stays.query('hotel_2_id != -1', inplace=True)
-                    grouping_columns = ['primary_star_rating', 'min_review_tier']
-
-                    stays.sort_values('stay_cost', inplace=True)
-                    unrestricted_low_cost_stays = stays.groupby(grouping_columns).nth(0)
-                    unrestricted_low_cost_stays['restricted'] = False
-
-                    stays.sort_values('cost_per_quality_unit', inplace=True)
-                    unrestricted_best_value_stays = stays.groupby(grouping_columns).nth(0)
-                    unrestricted_best_value_stays['restricted'] = False
-
-                    switches_with_both_benchmarks = \
-                        'entire_stay_cost_1 == entire_stay_cost_1 \
-                        and entire_stay_cost_2 == entire_stay_cost_2'
-
-                    stays.query(switches_with_both_benchmarks, inplace=True)
-
-                    stays.sort_values('stay_cost', inplace=True)
-                    restricted_low_cost_stays = stays.groupby(grouping_columns).nth(0)
-                    restricted_low_cost_stays['restricted'] = True
-
-                    stays.sort_values('cost_per_quality_unit', inplace=True)
-                    restricted_best_value_stays = stays.groupby(grouping_columns).nth(0)
-                    restricted_best_value_stays['restricted'] = True
-
-                    scenarios = [
-                        unrestricted_low_cost_stays,
-                        unrestricted_best_value_stays,
-                        restricted_low_cost_stays,
-                        restricted_best_value_stays, ]
-
-                    stays = concat(scenarios)
-                    stays.reset_index(inplace=True)
-                    stays.drop_duplicates(inplace=True)
-
-                    stays['city'] = city['city']
-                    stays['check_in'] = check_in
-                    stays['duration'] = duration
-                    stays['result_count'] = result_count
-
-                    all_stays.append(stays)
-                    logger.warn('{}, {:%Y-%m-%d}, {}'.format(city['city'], check_in, duration))
-
-        stays = concat(all_stays).to_csv('analysis_output.csv', index=False)
+        scenarios = self.load_scenarios(options['scenarios'])
+
+        if options['format'] == 'parquet':
+            if batch.pq is None:
+                raise CommandError('pyarrow is required for parquet output')
+            output_path = options['output'] or 'analysis_output'
+            writer = batch.ParquetWriter(output_path, self.partition_columns)
+        else:
+            output_path = options['output'] or 'analysis_output.csv'
+            writer = batch.CsvWriter(
+                output_path, get_output_columns(scenarios['grouping_columns']))
+
+        checkpoint_path = options['checkpoint'] or output_path + '.checkpoint'
+
+        base_check_in = datetime.strptime(scenarios['base_check_in'], '%Y-%m-%d')
+        check_in_range = date_range(
+            base_check_in, base_check_in + DateOffset(days=scenarios['check_in_day_count'] - 1))
+
+        base_data = scenarios['base_data'].copy()
+        if options['reuse_rates']:
+            base_data.update({
+                'reuse_rates': True,
+                'rate_span': (
+                    check_in_range[0],
+                    check_in_range[-1] + DateOffset(days=max(scenarios['stay_durations']))),
+            })
+
+        cells = [{
+            'base_data': base_data,
+            'grouping_columns': scenarios['grouping_columns'],
+            'city': city,
+            'check_in': check_in,
+            'duration': duration,
+        } for city in scenarios['cities']
+            for check_in in check_in_range
+            for duration in scenarios['stay_durations']]
+
+        engine = batch.BatchEngine(summarise_cell, writer, checkpoint_path, options['workers'])
+        failure_count = engine.run(cells, resume=options['resume'])
+
+        if failure_count > 0:
+            logger.warning(
+                '{} cells failed; rerun with --resume to retry them'.format(failure_count))
+
+
+def get_output_columns(grouping_columns):
+    """
+    Returns:
+        list: Columns of the rows from summarise_cell, including those only
+        present for searches with switches
+    """
+    fields = (tasks.FIELDS_REQUIRED_ON_RESULTS_PAGE +
+              tasks.REQUIRED_FIELDS_ONLY_PRESENT_IN_MULTI_NIGHT_SEARCH +
+              ['stay_cost', 'cost_per_quality_unit', 'restricted'])
+
+    return (grouping_columns + [field for field in fields if field not in grouping_columns] +
+            ['city', 'check_in', 'duration', 'result_count'])
+
+
+def select_scenario_stays(stays, grouping_columns):
+    """
+    Select the cheapest and best value stays per group, both unrestricted and
+    restricted to switches with both benchmarks, in a single groupby. Scores
+    of stays excluded by the restriction are masked with infinity, so groups
+    without any eligible stay select an ineligible one, which is discarded.
+
+    Returns:
+        DataFrame: Selected stays with grouping columns first and a
+        'restricted' flag, without duplicates
+    """
+    stays = stays.reset_index(drop=True)
+
+    switches_with_both_benchmarks = \
+        stays['entire_stay_cost_1'].notnull() & stays['entire_stay_cost_2'].notnull()
+
+    objectives = ['stay_cost', 'cost_per_quality_unit']
+    scores = stays[objectives]
+    restricted_scores = scores.where(switches_with_both_benchmarks, float('inf'))
+    scores = concat([scores, restricted_scores.add_prefix('restricted_')], axis=1)
+
+    selections = scores.groupby([stays[column] for column in grouping_columns]).idxmin()
+
+    scenarios = []
+    for column in selections.columns:
+        restricted = column.startswith('restricted_')
+        positions = selections[column].dropna().astype(int).values
+
+        selected = stays.iloc[positions]
+        if restricted:
+            selected = selected[switches_with_both_benchmarks.iloc[positions].values]
+
+        selected = selected.assign(restricted=restricted)
+        scenarios.append(selected)
+
+    stays = concat(scenarios)
+    other_columns = [column for column in stays.columns if column not in grouping_columns]
+    stays = stays[grouping_columns + other_columns]
+
+    return stays.drop_duplicates()
+
+
+def summarise_cell(cell):
+    """
+    Run a single search and return the cheapest and best value stays per
+    group, with and without requiring both benchmarks.
+
+    Args:
+        cell (dict): base_data, grouping_columns, city, check_in and duration
+    """
+    city = cell['city']
+    check_in = cell['check_in']
+    duration = cell['duration']
+
+    check_out = check_in + DateOffset(days=duration)
+    check_in_range = date_range(check_in, check_out - DateOffset(days=1))
+    data = cell['base_data'].copy()
+    data.update({
+        'checkIn': check_in,
+        'checkOut': check_out,
+        'check_in_range': check_in_range,
+        'country':  city['country'],
+        'state':  city['state'],
+        'city':  city['city'],
+    })
+
+    stays = tasks.execute_search(data, '', None)
+    result_count = len(stays)
+    if result_count == 0:
+        return DataFrame()
+
+    stays = stays.query('hotel_2_id != -1')
+    stays = select_scenario_stays(stays, cell['grouping_columns'])
+
+    stays['city'] = city['city']
+    stays['check_in'] = check_in
+    stays['duration'] = duration
+    stays['result_count'] = result_count
+
+    logger.warn('{}, {:%Y-%m-%d}, {}'.format(city['city'], check_in, duration))
+
+    return stays
@@ -0,0 +1,125 @@
+"""
+Prometheus-style metrics shared between worker and web processes.
+
+Workers fork per job, so aggregates are kept in Redis rather than in memory.
+Histogram buckets are stored non-cumulatively and accumulated when rendered.
+"""
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'search:metrics:'
+
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MEGABYTE_BUCKETS = (10, 50, 100, 250, 500, 1000, 2000, 4000)
+ROW_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+HISTOGRAMS = OrderedDict([
+    ('search_stage_wall_seconds', ('Wall time per search stage', SECONDS_BUCKETS)),
+    ('search_stage_cpu_seconds', ('CPU time per search stage', SECONDS_BUCKETS)),
+    ('search_stage_peak_memory_megabytes', ('Peak memory per search stage', MEGABYTE_BUCKETS)),
+    ('search_stage_rows', ('Rows output per search stage', ROW_BUCKETS)),
+    ('search_wall_seconds', ('Wall time per search', SECONDS_BUCKETS)),
+])
+
+
+def metrics_enabled():
+    return getattr(settings, 'SEARCH_METRICS_ENABLED', True)
+
+
+def get_allowed_ips():
+    # Addresses of the scrapers, as seen by Django (i.e. REMOTE_ADDR)
+    return getattr(settings, 'SEARCH_METRICS_ALLOWED_IPS', ['127.0.0.1'])
+
+
+def format_labels(labels):
+    return ','.join('{}="{}"'.format(name, value) for name, value in sorted(labels.items()))
+
+
+def observe(pipeline, name, value, **labels):
+    """
+    Queue a histogram observation on a Redis pipeline, so that all
+    observations for a search are sent in a single round trip.
+    """
+    _, buckets = HISTOGRAMS[name]
+    label_string = format_labels(labels)
+
+    bucket = next((str(le) for le in buckets if value <= le), '+Inf')
+
+    pipeline.hincrby(PREFIX + name, '{}|{}'.format(label_string, bucket), 1)
+    pipeline.hincrbyfloat(PREFIX + name, '{}|sum'.format(label_string), value)
+    pipeline.hincrby(PREFIX + name, '{}|count'.format(label_string), 1)
+
+
+def record(observations):
+    """
+    Args:
+        observations (list): (name, value, labels) tuples
+    """
+    if not metrics_enabled():
+        return
+
+    try:
+        pipeline = settings.REDIS_CONNECTION.pipeline(transaction=False)
+        for name, value, labels in observations:
+            observe(pipeline, name, value, **labels)
+        pipeline.execute()
+    except RedisError:
+        logger.warning('Unable to record search metrics', exc_info=True)
+
+
+def render_samples(name, metric_type, description, samples):
+    """
+    Args:
+        samples (list): (labels dict, value) tuples
+
+    Returns:
+        str: A single metric in the Prometheus text exposition format
+    """
+    lines = [
+        '# HELP {} {}'.format(name, description),
+        '# TYPE {} {}'.format(name, metric_type),
+    ]
+    for labels, value in samples:
+        lines.append('{}{{{}}} {}'.format(name, format_labels(labels), value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def render():
+    """
+    Returns:
+        str: All histograms in the Prometheus text exposition format
+    """
+    connection = settings.REDIS_CONNECTION
+    lines = []
+
+    for name, (description, buckets) in HISTOGRAMS.items():
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} histogram'.format(name))
+
+        values = {}
+        for field, value in connection.hgetall(PREFIX + name).items():
+            label_string, suffix = field.decode('utf-8').rsplit('|', 1)
+            values.setdefault(label_string, {})[suffix] = float(value)
+
+        for label_string in sorted(values):
+            series = values[label_string]
+            separator = ',' if label_string else ''
+
+            cumulative_count = 0
+            for le in [str(le) for le in buckets] + ['+Inf']:
+                cumulative_count += series.get(le, 0)
+                lines.append('{}_bucket{{{}{}le="{}"}} {:.0f}'.format(
+                    name, label_string, separator, le, cumulative_count))
+
+            braces = '{{{}}}'.format(label_string) if label_string else ''
+            lines.append('{}_sum{} {}'.format(name, braces, series.get('sum', 0)))
+            lines.append('{}_count{} {:.0f}'.format(name, braces, series.get('count', 0)))
+
+    return '\n'.join(lines) + '\n'
@@ -1,3 +1,6 @@
+from django.conf import settings
+
+
 class ContextSwitchMixin(object):
     """Designed for a/b testing ie url?switch=ab
     """
@@ -8,4 +11,7 @@ class ContextSwitchMixin(object):
             context.update({
                 'ctx_switch': 'ctx_switch_{}'.format(switch)
             })
+            # Sent with the search to apply the variant's filter settings
+            if switch in getattr(settings, 'SEARCH_FILTER_VARIANTS', {}):
+                context['filter_variant'] = switch
         return context
@@ -19,3 +19,7 @@ class LatestSaving(models.Model):
 
     class Meta:
         ordering = ['position']
+
+
+# Connect cache invalidation wherever the app is installed
+from apps.search import signals  # noqa
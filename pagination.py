@@ -0,0 +1,128 @@
+"""
+Server-side pagination of results (protocol 3).
+
+The first message of a search carries page 1 with the cost/distance ranges
+and the total result count. Further pages, optionally narrowed to cost and
+distance ranges, are requested with the 'page' action and served from the
+session's stored result set, with only the hotels on that page. Workers run
+jobs in-process, so recently paged result sets are kept in memory.
+"""
+import logging
+from collections import OrderedDict
+from math import ceil
+
+from django.conf import settings
+
+from apps.search import store
+
+
+logger = logging.getLogger(__name__)
+
+# Range filter name (as in the cost/distance ranges sent with results) to
+# result field and bound
+RANGE_FILTERS = OrderedDict([
+    ('minStayCost', ('rounded_stay_cost', 'min')),
+    ('maxStayCost', ('rounded_stay_cost', 'max')),
+    ('minNightlyCost', ('rounded_nightly_cost', 'min')),
+    ('maxNightlyCost', ('rounded_nightly_cost', 'max')),
+    ('minDistanceSwitch', ('distance_in_km', 'min')),
+    ('maxDistanceSwitch', ('distance_in_km', 'max')),
+])
+
+
+def get_page_size(criteria):
+    default_page_size = getattr(settings, 'RESULTS_PAGE_SIZE', 50)
+    max_page_size = getattr(settings, 'RESULTS_MAX_PAGE_SIZE', 200)
+
+    try:
+        page_size = int(criteria.get('page_size') or default_page_size)
+    except (TypeError, ValueError):
+        page_size = default_page_size
+
+    return max(1, min(page_size, max_page_size))
+
+
+def filter_results(results, filters):
+    """
+    Args:
+        filters (dict): Any of RANGE_FILTERS, with inclusive bounds. Stays
+            without a value (e.g. the distance of a non-switching stay) are
+            never excluded
+
+    Returns:
+        DataFrame
+    """
+    for name, value in (filters or {}).items():
+        if name not in RANGE_FILTERS:
+            raise ValueError('Unknown filter {}'.format(name))
+
+        field, bound = RANGE_FILTERS[name]
+        if field not in results.columns or value is None:
+            continue
+
+        values = results[field]
+        if bound == 'min':
+            results = results[values.isnull() | (values >= float(value))]
+        else:
+            results = results[values.isnull() | (values <= float(value))]
+
+    return results
+
+
+def get_page(results, page, page_size):
+    """
+    Args:
+        page (int): From 1
+
+    Returns:
+        tuple: (page of results, page number within range, page count)
+    """
+    page_count = max(1, int(ceil(len(results) / page_size)))
+    page = max(1, min(int(page), page_count))
+    start = (page - 1) * page_size
+
+    return results.iloc[start:start + page_size], page, page_count
+
+
+class ResultSetCache(object):
+    """
+    Worker-local LRU of stored result sets, so that paging through results
+    doesn't reload and deserialise the whole set for each page. Each hit is
+    checked against the stored generation, as the result set may since have
+    expired or been replaced by a repeat search under the same key.
+    """
+    def __init__(self):
+        self.result_sets = OrderedDict()  # result_key to (generation, stays)
+
+    def get(self, result_key):
+        """
+        Returns:
+            DataFrame, or None if the result set has expired
+        """
+        generation = store.get_generation(result_key)
+        if generation is None:
+            self.result_sets.pop(result_key, None)
+            return None
+
+        if result_key in self.result_sets:
+            cached_generation, stays = self.result_sets[result_key]
+            if cached_generation == generation:
+                self.result_sets.move_to_end(result_key)
+                return stays
+
+        # Loaded after reading the generation, so a result set saved in
+        # between is just reloaded on the next hit
+        stays = store.load_stays(result_key)
+        if stays is None:
+            self.result_sets.pop(result_key, None)
+            return None
+
+        self.result_sets[result_key] = (generation, stays)
+        self.result_sets.move_to_end(result_key)
+        if len(self.result_sets) > getattr(settings, 'RESULT_SET_CACHE_SIZE', 4):
+            self.result_sets.popitem(last=False)
+
+        return stays
+
+
+result_set_cache = ResultSetCache()
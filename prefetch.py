@@ -0,0 +1,165 @@
+"""
+Speculative prefetching of searches the user is likely to make next.
+
+After a search completes, searches for the same place with check-in or
+check-out a night either side are enqueued at low priority. They only fill
+the shared result cache (see coalesce), so if the user then changes dates the
+results are served immediately, or the search joins the in-flight prefetch.
+
+Prefetching is limited per session and globally per time window, and a
+client's prefetches are cancelled when it disconnects. Enabled with
+SEARCH_PREFETCH_ENABLED.
+"""
+import logging
+import time
+
+from django.conf import settings
+from pandas import DateOffset, datetime
+
+from apps.search import coalesce, metrics, scheduling, utils
+
+
+logger = logging.getLogger(__name__)
+
+SESSION_BUDGET_PREFIX = 'search:prefetch:session:'
+GLOBAL_BUDGET_PREFIX = 'search:prefetch:global:'
+CLIENT_JOBS_PREFIX = 'search:prefetch:jobs:'
+PREFETCHED_PREFIX = 'search:prefetched:'
+COUNTS_KEY = 'search:metrics:prefetches'
+
+# Criteria set by scheduling for a specific job
+JOB_CRITERIA = ['search_id', 'deadline', 'supersession_group', 'check_in_range']
+
+
+def prefetch_enabled():
+    return getattr(settings, 'SEARCH_PREFETCH_ENABLED', False)
+
+
+def get_budget_window_in_seconds():
+    return getattr(settings, 'SEARCH_PREFETCH_BUDGET_WINDOW_IN_SECONDS', 600)
+
+
+def get_variants(criteria):
+    """
+    Returns:
+        list: Criteria with check-in or check-out moved by a night, excluding
+        past check-ins and stays of less than a night
+    """
+    check_in = datetime.strptime(criteria['checkIn'], '%Y-%m-%d')
+    check_out = datetime.strptime(criteria['checkOut'], '%Y-%m-%d')
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    night = DateOffset(days=1)
+
+    variants = []
+    for variant_check_in, variant_check_out in [
+            (check_in - night, check_out),
+            (check_in + night, check_out),
+            (check_in, check_out - night),
+            (check_in, check_out + night)]:
+        if variant_check_in < today or variant_check_out <= variant_check_in:
+            continue
+
+        variant = {key: value for key, value in criteria.items() if key not in JOB_CRITERIA}
+        variant.update({
+            'checkIn': variant_check_in.strftime('%Y-%m-%d'),
+            'checkOut': variant_check_out.strftime('%Y-%m-%d'),
+            'prefetch': True,
+        })
+        variants.append(variant)
+
+    return variants
+
+
+def consume_budget(session_key):
+    """
+    Returns:
+        bool: True if both the session and the global budget allow another
+        prefetch in the current window
+    """
+    connection = settings.REDIS_CONNECTION
+    window = get_budget_window_in_seconds()
+
+    session_budget_key = SESSION_BUDGET_PREFIX + str(session_key)
+    global_budget_key = GLOBAL_BUDGET_PREFIX + str(int(time.time() // window))
+
+    pipeline = connection.pipeline()
+    pipeline.incr(session_budget_key)
+    pipeline.expire(session_budget_key, window)
+    pipeline.incr(global_budget_key)
+    pipeline.expire(global_budget_key, window)
+    session_count, _, global_count, _ = pipeline.execute()
+
+    return (session_count <= getattr(settings, 'SEARCH_PREFETCH_SESSION_BUDGET', 8) and
+            global_count <= getattr(settings, 'SEARCH_PREFETCH_GLOBAL_BUDGET', 500))
+
+
+def record(outcome):
+    settings.REDIS_CONNECTION.hincrby(COUNTS_KEY, outcome, 1)
+
+
+def schedule(function, criteria, session_key, reply_channel):
+    """
+    Enqueue prefetches of the variants of a completed search that are
+    neither cached nor in flight, as budgets allow.
+    """
+    if not prefetch_enabled() or criteria.get('prefetch') or criteria.get('data_mining'):
+        return
+
+    connection = settings.REDIS_CONNECTION
+
+    for variant in get_variants(criteria):
+        result_key = utils.create_result_key(variant)
+
+        if connection.exists(coalesce.FRESH_PREFIX + result_key) or \
+                connection.exists(coalesce.IN_FLIGHT_PREFIX + result_key):
+            continue
+
+        if not consume_budget(session_key):
+            record('over_budget')
+            break
+
+        # No reply channel, so the prefetch neither replies nor supersedes
+        job = scheduling.enqueue(function, variant, None, None)
+        record('enqueued')
+
+        if reply_channel is not None:
+            client_jobs_key = CLIENT_JOBS_PREFIX + reply_channel
+            pipeline = connection.pipeline()
+            pipeline.sadd(client_jobs_key, job.id)
+            pipeline.expire(client_jobs_key, scheduling.get_deadline_in_seconds())
+            pipeline.execute()
+
+
+def mark_prefetched(result_key):
+    settings.REDIS_CONNECTION.setex(
+        PREFETCHED_PREFIX + result_key, coalesce.get_shared_result_cache_ttl(), 1)
+
+
+def record_if_hit(result_key):
+    """
+    Count a hit if a cached result set was prefetched, once per prefetch
+    """
+    if settings.REDIS_CONNECTION.delete(PREFETCHED_PREFIX + result_key):
+        record('hit')
+
+
+def cancel_client_prefetches(reply_channel):
+    connection = settings.REDIS_CONNECTION
+    client_jobs_key = CLIENT_JOBS_PREFIX + reply_channel
+
+    for search_id in connection.smembers(client_jobs_key):
+        scheduling.cancel_search(search_id.decode('utf-8'))
+    connection.delete(client_jobs_key)
+
+
+def render_metrics():
+    """
+    Returns:
+        str: Prefetch counts in the Prometheus text format
+    """
+    counts = [
+        ({'outcome': outcome.decode('utf-8')}, int(count))
+        for outcome, count in settings.REDIS_CONNECTION.hgetall(COUNTS_KEY).items()]
+
+    return metrics.render_samples(
+        'search_prefetches_total', 'counter', 'Speculative prefetches by outcome', counts)
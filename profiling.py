@@ -0,0 +1,144 @@
+import json
+import logging
+import resource
+import time
+import tracemalloc
+
+from django.conf import settings
+from pandas import DataFrame
+
+from apps.search import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def reset_peak_rss():
+    """
+    Reset the process's peak resident set size (Linux only), so that the
+    peak after a stage is that stage's own rather than the process lifetime's
+
+    Returns:
+        bool: True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb():
+    """
+    Returns:
+        float: Peak resident set size since the last reset, or since the
+        process started where it can't be reset
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1000
+    except OSError:
+        pass
+
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000
+
+
+class SearchProfile(object):
+    """
+    Record wall time, CPU time, peak memory and output size for each stage of
+    execute.search, emitted as a single structured log record per search and
+    aggregated as histograms for the metrics endpoint.
+
+    Peak memory is the high-water mark of resident memory during each stage,
+    reset before the stage where the platform allows. Otherwise (e.g. on
+    macOS) only growth of the process's lifetime peak is recorded, which is
+    zero for a stage that stays below the peak of an earlier search. Set
+    SEARCH_PROFILE_TRACE_MEMORY to additionally trace allocations within each
+    stage; this is exact but slows the search considerably.
+    """
+    def __init__(self, criteria):
+        self.criteria = criteria
+        self.stages = []
+        self.trace_memory = getattr(settings, 'SEARCH_PROFILE_TRACE_MEMORY', False)
+        self.start_time = time.perf_counter()
+
+    def run(self, stage, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs), recording it as the named stage.
+
+        Returns:
+            The function's return value
+        """
+        if self.trace_memory:
+            tracemalloc.start()
+
+        peak_reset = reset_peak_rss()
+        peak_rss_before = get_peak_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+
+        record = {'stage': stage}
+        result = None
+
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            peak_rss = get_peak_rss_mb()
+            record.update({
+                'wall_time': time.perf_counter() - wall_start,
+                'cpu_time': time.process_time() - cpu_start,
+                'peak_rss_mb': peak_rss if peak_reset else peak_rss - peak_rss_before,
+            })
+
+            # Always stopped, as tracing would otherwise slow every later job
+            if self.trace_memory:
+                record['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1000000
+                tracemalloc.stop()
+
+            # Stages return either a frame or a tuple of frames (e.g. get_rates)
+            frames = result if isinstance(result, tuple) else (result,)
+            frames = [frame for frame in frames if isinstance(frame, DataFrame)]
+            if frames:
+                record['rows'], record['columns'] = frames[0].shape
+
+            self.stages.append(record)
+
+        return result
+
+    def emit(self):
+        wall_time = time.perf_counter() - self.start_time
+
+        # Searches which failed or were cancelled are emitted too
+        errors = [record['error'] for record in self.stages if 'error' in record]
+        outcome = errors[0] if errors else 'ok'
+
+        logger.info(json.dumps({
+            'event': 'search_profile',
+            'place_name': self.criteria.get('place_name'),
+            'currency': self.criteria.get('currency'),
+            'night_count': len(self.criteria['check_in_range']),
+            'wall_time': wall_time,
+            'outcome': outcome,
+            'stages': self.stages,
+        }))
+
+        observations = [('search_wall_seconds', wall_time, {'outcome': outcome})]
+        for record in self.stages:
+            labels = {'stage': record['stage']}
+            observations.extend([
+                ('search_stage_wall_seconds', record['wall_time'], labels),
+                ('search_stage_cpu_seconds', record['cpu_time'], labels),
+                ('search_stage_peak_memory_megabytes',
+                 record.get('peak_traced_mb', record['peak_rss_mb']), labels),
+            ])
+            if 'rows' in record:
+                observations.append(('search_stage_rows', record['rows'], labels))
+
+        metrics.record(observations)
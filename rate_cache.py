@@ -0,0 +1,115 @@
+"""
+Per-night rate reuse for batch searches over overlapping date windows.
+
+Rates for a place are fetched once for the whole span of check-ins being
+analysed, and each search is served the nights within its own window. Costs
+for the entire stay are derived from the nightly rates: a rate option only
+qualifies if it is available on every night of the window.
+
+Suppliers may price long stays differently from short ones, so this is only
+suitable for analysis and is enabled per search with criteria['reuse_rates'].
+"""
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from pandas import DateOffset, date_range
+
+
+logger = logging.getLogger(__name__)
+
+NIGHT_COLUMN = 'check_in'
+COST_COLUMN = 'cost'
+ENTIRE_STAY_COST_COLUMN = 'entire_stay_cost'
+
+# Criteria which, together with the span, determine the rates returned
+SPAN_DIMENSIONS = [
+    'place_name', 'country', 'state', 'county', 'city', 'latitude', 'longitude',
+    'occupants', 'currency', 'source_market',
+]
+
+
+def derive_entire_stay_costs(rates, span_entire_stay_costs, night_count):
+    """
+    Args:
+        rates (DataFrame): Nightly rates within a single window
+        span_entire_stay_costs (DataFrame): As returned by the supplier for
+            the whole span; determines the rate option columns and provides
+            any columns not present in the nightly rates
+        night_count (int)
+
+    Returns:
+        DataFrame: Entire stay costs for the window
+    """
+    key_columns = [
+        column for column in span_entire_stay_costs.columns
+        if column in rates.columns and column not in [NIGHT_COLUMN, COST_COLUMN]]
+
+    # Cheapest rate per option and night, then options available every night
+    nightly_costs = rates.groupby(key_columns + [NIGHT_COLUMN])[COST_COLUMN].min()
+    nightly_costs = nightly_costs.reset_index().groupby(key_columns)[COST_COLUMN]
+    entire_stay_costs = nightly_costs.agg(['sum', 'count']).reset_index()
+    entire_stay_costs = entire_stay_costs[entire_stay_costs['count'] == night_count]
+    entire_stay_costs = entire_stay_costs.drop('count', axis=1).rename(
+        columns={'sum': ENTIRE_STAY_COST_COLUMN})
+
+    other_columns = [
+        column for column in span_entire_stay_costs.columns
+        if column not in key_columns and column != ENTIRE_STAY_COST_COLUMN]
+    if other_columns:
+        entire_stay_costs = entire_stay_costs.merge(
+            span_entire_stay_costs[key_columns + other_columns].drop_duplicates(key_columns),
+            on=key_columns, how='left')
+
+    return entire_stay_costs[list(span_entire_stay_costs.columns)]
+
+
+class RateCache(object):
+    """
+    Args:
+        max_spans (int): Spans kept in memory. Batch cells are ordered by
+            place, so a worker rarely needs more than the current place
+    """
+    def __init__(self, max_spans=2):
+        self.max_spans = max_spans
+        self.spans = OrderedDict()
+
+    def get_rates(self, fetch, criteria):
+        """
+        Drop-in replacement for a datafeeds.get_<supplier>_rates function.
+
+        Args:
+            fetch (callable): The supplier's get_rates function
+            criteria (dict): Including rate_span, the (check_in, check_out) of
+                the whole span, and check_in_range for this search
+        """
+        span_check_in, span_check_out = criteria['rate_span']
+        span_key = tuple([fetch.__name__, span_check_in, span_check_out] +
+                         [criteria.get(dimension) for dimension in SPAN_DIMENSIONS])
+
+        if span_key in self.spans:
+            self.spans.move_to_end(span_key)
+        else:
+            span_criteria = criteria.copy()
+            span_criteria.update({
+                'checkIn': span_check_in,
+                'checkOut': span_check_out,
+                'check_in_range': date_range(span_check_in, span_check_out - DateOffset(days=1)),
+            })
+            logger.warning('Fetching rates for {} from {} to {}'.format(
+                criteria.get('city'), span_check_in, span_check_out))
+
+            self.spans[span_key] = fetch(span_criteria)
+            if len(self.spans) > self.max_spans:
+                self.spans.popitem(last=False)
+
+        span_rates, span_entire_stay_costs = self.spans[span_key]
+
+        rates = span_rates[span_rates[NIGHT_COLUMN].isin(criteria['check_in_range'])].copy()
+        entire_stay_costs = derive_entire_stay_costs(
+            rates, span_entire_stay_costs, len(criteria['check_in_range']))
+
+        return rates, entire_stay_costs
+
+
+rate_cache = RateCache(max_spans=getattr(settings, 'RATE_CACHE_SPANS', 2))
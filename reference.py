@@ -0,0 +1,98 @@
+"""
+Process-wide cache of the Hotelbeds reference data used by the stay detail
+view. Facilities, rooms and boards are loaded once per version, and each
+hotel's facility list (joined to facility descriptions) is memoised. The
+version is bumped in the shared Django cache when the reference data changes
+(see signals), and the facility lists of changed hotels are evicted (see
+hotel_changes).
+"""
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from pandas import DataFrame, merge
+
+from apps.apis.models import HotelbedsRoom, HotelbedsBoard, HotelbedsFacility
+from apps.search import hotel_changes
+
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'reference_data_version'
+
+
+def get_version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def invalidate():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+
+
+class ReferenceData(object):
+    def __init__(self):
+        self.version = None
+
+    def load(self):
+        self.version = get_version()
+        _, self.changes_checked_at = hotel_changes.get_changes(None)
+        self.facilities = DataFrame(
+            list(HotelbedsFacility.objects.values('code', 'group', 'description')),
+            columns=['code', 'group', 'description'])
+        self.rooms = dict(HotelbedsRoom.objects.values_list('code', 'description'))
+        self.boards = dict(HotelbedsBoard.objects.values_list('code', 'description'))
+        self.hotel_facilities = OrderedDict()
+
+    def check_validity(self):
+        if self.version is None or get_version() != self.version:
+            self.load()
+            return
+
+        changed_hotel_ids, self.changes_checked_at = hotel_changes.get_changes(
+            self.changes_checked_at)
+        if changed_hotel_ids is None:
+            self.hotel_facilities.clear()
+        else:
+            for hotel_id in changed_hotel_ids:
+                self.hotel_facilities.pop(hotel_id, None)
+
+    def get_room_description(self, code):
+        self.check_validity()
+        return self.rooms[code]
+
+    def get_board_description(self, code):
+        self.check_validity()
+        return self.boards[code]
+
+    def get_hotel_facilities(self, hotel):
+        """
+        Returns:
+            list: Available facility dicts with code, group and description,
+            or an empty list if the hotel's facility data can't be parsed
+        """
+        self.check_validity()
+
+        if hotel.hotel_id in self.hotel_facilities:
+            self.hotel_facilities.move_to_end(hotel.hotel_id)
+            return self.hotel_facilities[hotel.hotel_id]
+
+        try:  # pragma: no cover
+            hotel_facilities = DataFrame(hotel.facilities)
+            hotel_facilities.query('available == True', inplace=True)
+            hotel_facilities = merge(hotel_facilities, self.facilities, on=['code', 'group'])
+            hotel_facilities = hotel_facilities.to_dict('records')
+        except Exception:
+            hotel_facilities = []
+
+        self.hotel_facilities[hotel.hotel_id] = hotel_facilities
+        if len(self.hotel_facilities) > getattr(settings, 'HOTEL_FACILITY_CACHE_SIZE', 10000):
+            self.hotel_facilities.popitem(last=False)
+
+        return hotel_facilities
+
+
+reference_data = ReferenceData()
@@ -0,0 +1,164 @@
+"""
+Refinement of completed searches with other filter parameters or sort orders.
+
+Searches keep their rates and unfiltered stays in the result store once they
+have replied (see store.save_candidates), so refined results only repeat the
+cheap final stages of execute.search. Refined result sets are stored under their own key, for
+the stay detail view and for identical refinements.
+
+Named filter variants (SEARCH_FILTER_VARIANTS) allow filter settings to be
+A/B tested, e.g. ?switch=b on the inputs page sends the 'b' variant with the
+search, and the variant's results are refined from the shared search.
+"""
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+
+from apps.search import execute, store
+from apps.search.profiling import SearchProfile
+
+
+logger = logging.getLogger(__name__)
+
+FILTER_PARAMETER_TYPES = {
+    'sample_rate': int,
+    'min_saving': float,
+    'min_saving_percentage': float,
+    'max_upgrade_cost': float,
+    'max_upgrade_cost_percentage': float,
+}
+
+# Fields on the results page which results may be sorted by
+SORT_COLUMNS = [
+    'default_sort',
+    'rounded_stay_cost',
+    'rounded_nightly_cost',
+    'distance_in_km',
+    'review_score',
+    'primary_star_rating',
+    'switch_benefit',
+]
+
+
+class CandidatesExpired(Exception):
+    pass
+
+
+def get_filter_variants():
+    """
+    Returns:
+        dict: Filter parameter overrides keyed by variant name
+    """
+    return getattr(settings, 'SEARCH_FILTER_VARIANTS', {})
+
+
+def get_filter_parameters(variant=None, overrides=None):
+    """
+    Args:
+        variant (str): Name of a filter variant, applied over the defaults
+        overrides (dict): Individual parameters from the client
+
+    Returns:
+        dict: Complete filter parameters for filter_and_sort.filter_stays
+
+    Raises:
+        ValueError: For an unknown variant or parameter, or an invalid value
+    """
+    parameters = dict(execute.FILTER_PARAMETERS)
+
+    if variant:
+        if variant not in get_filter_variants():
+            raise ValueError('Unknown filter variant {}'.format(variant))
+        parameters.update(get_filter_variants()[variant])
+
+    for name, value in (overrides or {}).items():
+        if name not in FILTER_PARAMETER_TYPES:
+            raise ValueError('Unknown filter parameter {}'.format(name))
+        parameters[name] = FILTER_PARAMETER_TYPES[name](value)
+
+    return parameters
+
+
+def get_sort(sort):
+    """
+    Args:
+        sort (dict): {'column': ..., 'ascending': ...} from the client
+
+    Returns:
+        tuple: (column, ascending), or None for the default sort
+    """
+    if not sort:
+        return None
+
+    if sort.get('column') not in SORT_COLUMNS:
+        raise ValueError('Unsupported sort column {}'.format(sort.get('column')))
+
+    return sort['column'], bool(sort.get('ascending', True))
+
+
+def is_default(filter_parameters, sort):
+    return filter_parameters == execute.FILTER_PARAMETERS and sort is None
+
+
+def get_refined_result_key(result_key, generation, filter_parameters, sort):
+    """
+    Refined result sets are specific to a generation of the search's result
+    set (see store.save_stays), so a repeat search never gets refinements of
+    the previous one.
+    """
+    if is_default(filter_parameters, sort):
+        return result_key
+
+    parameters = json.dumps([filter_parameters, sort], sort_keys=True)
+    return '{}:refined:{}:{}'.format(
+        result_key, generation, hashlib.sha1(parameters.encode('utf-8')).hexdigest())
+
+
+def get_candidates_key(result_key, generation):
+    return '{}:{}'.format(result_key, generation)
+
+
+def refine(criteria, result_key, filter_parameters, sort=None, candidates=None):
+    """
+    Args:
+        candidates (tuple): The search's (rates, stays) if still in memory;
+            otherwise they are loaded from the result store
+
+    Returns:
+        tuple: (refined result key, stays)
+
+    Raises:
+        CandidatesExpired: If the search must be run again
+    """
+    generation = store.get_generation(result_key)
+    if generation is None:
+        raise CandidatesExpired(result_key)
+
+    refined_result_key = get_refined_result_key(result_key, generation, filter_parameters, sort)
+
+    # In-memory candidates are those of a search which has just completed
+    if candidates is None or is_default(filter_parameters, sort):
+        stays = store.load_stays(refined_result_key)
+        if stays is not None:
+            store.touch(refined_result_key)
+            return refined_result_key, stays
+
+    if candidates is None:
+        candidates = store.load_candidates(get_candidates_key(result_key, generation))
+    if candidates is None:
+        raise CandidatesExpired(result_key)
+    rates, stays = candidates
+
+    profile = SearchProfile(criteria)
+    try:
+        _, stays = execute.finalise(
+            criteria, rates, stays, profile, execute.get_cancellation_check(None),
+            filter_parameters, sort=sort)
+    finally:
+        profile.emit()
+
+    store.save_stays(refined_result_key, stays)
+
+    return refined_result_key, stays
@@ -0,0 +1,111 @@
+"""
+TripAdvisor reviews for the stay detail view.
+
+Reviews for both hotels of a stay are fetched concurrently within a time
+budget, so the page is no longer bounded by the slowest serial call. Reviews
+are cached per TripAdvisor id: fresh entries are served directly, stale ones
+are served while being refreshed in the background, and missing ones that
+don't arrive within the budget are left blank but cached when they do.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.cache import cache
+
+import apps.apis.tripadvisor.api as tripadvisor
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = 'tripadvisor_review:'
+
+
+class ReviewFetcher(object):
+    """
+    Args:
+        fetch (callable): Takes a TripAdvisor id and returns its review.
+            Replaceable so the fetcher can be exercised against a stub server
+        max_workers (int): Concurrent fetches across all requests
+    """
+    def __init__(self, fetch=None, max_workers=8):
+        self.fetch = fetch or tripadvisor.get_tripadvisor_review
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.refreshing = {}  # TripAdvisor id to the Future of its refresh
+        self.lock = threading.Lock()
+
+    def refresh(self, tripadvisor_id):
+        try:
+            review = self.fetch(tripadvisor_id)
+            cache.set(
+                CACHE_PREFIX + str(tripadvisor_id),
+                {'review': review, 'fetched_at': time.time()},
+                getattr(settings, 'TRIPADVISOR_REVIEW_STALE_TTL', 604800))
+            return review
+        finally:
+            with self.lock:
+                self.refreshing.pop(tripadvisor_id, None)
+
+    def submit_refresh(self, tripadvisor_id):
+        """
+        Returns:
+            Future: Of the refresh already running for this id, if any, so
+            concurrent requests for the same review wait on a single fetch
+        """
+        # Submitted under the lock, so the refresh can't remove its id first
+        with self.lock:
+            if tripadvisor_id not in self.refreshing:
+                self.refreshing[tripadvisor_id] = self.executor.submit(
+                    self.refresh, tripadvisor_id)
+            return self.refreshing[tripadvisor_id]
+
+    def get_reviews(self, tripadvisor_ids, timeout=None):
+        """
+        Args:
+            tripadvisor_ids (list)
+            timeout (float): Seconds to wait for uncached reviews; defaults to
+                TRIPADVISOR_REVIEW_TIMEOUT
+
+        Returns:
+            list: Reviews in the order requested, None where unavailable
+        """
+        if timeout is None:
+            timeout = getattr(settings, 'TRIPADVISOR_REVIEW_TIMEOUT', 2)
+        fresh_ttl = getattr(settings, 'TRIPADVISOR_REVIEW_TTL', 86400)
+
+        cached = cache.get_many([CACHE_PREFIX + str(tripadvisor_id)
+                                 for tripadvisor_id in tripadvisor_ids])
+
+        reviews = [None] * len(tripadvisor_ids)
+        futures = {}
+
+        for idx, tripadvisor_id in enumerate(tripadvisor_ids):
+            entry = cached.get(CACHE_PREFIX + str(tripadvisor_id))
+
+            if entry is None:
+                futures[idx] = self.submit_refresh(tripadvisor_id)
+                continue
+
+            reviews[idx] = entry['review']
+            if time.time() - entry['fetched_at'] > fresh_ttl:
+                self.submit_refresh(tripadvisor_id)  # Stale; revalidate in background
+
+        if futures:
+            done, _ = wait(list(futures.values()), timeout=timeout)
+
+            for idx, future in futures.items():
+                if future not in done:
+                    logger.warning('TripAdvisor review {} not fetched within {}s'.format(
+                        tripadvisor_ids[idx], timeout))
+                elif future.exception() is not None:
+                    logger.warning('TripAdvisor review {} could not be fetched: {}'.format(
+                        tripadvisor_ids[idx], future.exception()))
+                else:
+                    reviews[idx] = future.result()
+
+        return reviews
+
+
+review_fetcher = ReviewFetcher(max_workers=getattr(settings, 'TRIPADVISOR_REVIEW_THREADS', 8))
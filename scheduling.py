@@ -0,0 +1,247 @@
+"""
+Scheduling of search jobs onto the per-currency RQ queues.
+
+Interactive searches go to the currency's queue and everything else (data
+mining, prefetching) to its low priority counterpart; workers listen to all
+interactive queues before any low priority one. Jobs carry a deadline after
+which nobody is waiting for the result, and a client's new search supersedes
+its previous one, so workers don't spend time on results nobody will see.
+Follow-up requests on a search's results (refining, paging) only supersede
+earlier requests of the same kind, so they never cancel the search itself.
+Searches already running are cancelled cooperatively: execute.search checks
+between stages and raises SearchCancelled.
+"""
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from apps.search import metrics
+
+
+logger = logging.getLogger(__name__)
+
+LATEST_SEARCH_PREFIX = 'search:latest:'
+CANCELLED_PREFIX = 'search:cancelled:'
+DROPPED_JOBS_KEY = 'search:metrics:dropped_jobs'
+
+LOW_PRIORITY_SUFFIX = '-low'
+
+# A client's job supersedes its previous job in the same group
+SEARCH_GROUP = 'search'
+SUPERSESSION_GROUPS = [SEARCH_GROUP, 'refine', 'page']
+
+# Rebuilds of shared data, listened to after every search queue
+MAINTENANCE_QUEUE_NAME = 'maintenance'
+MAINTENANCE_LOCK_PREFIX = 'search:maintenance:'
+
+
+class SearchCancelled(Exception):
+    pass
+
+
+def get_deadline_in_seconds():
+    # How long a websocket client usefully waits for its results
+    return getattr(settings, 'SEARCH_JOB_DEADLINE_IN_SECONDS', 60)
+
+
+def get_queue_names():
+    """
+    Returns:
+        list: Every queue, in the order workers should listen to them
+    """
+    currencies = list(settings.CURRENCY_SYMBOLS.keys())
+    return (currencies + [currency + LOW_PRIORITY_SUFFIX for currency in currencies] +
+            [MAINTENANCE_QUEUE_NAME])
+
+
+def get_queue_name(criteria):
+    if criteria.get('data_mining') or criteria.get('prefetch'):
+        return criteria['currency'] + LOW_PRIORITY_SUFFIX
+    return criteria['currency']
+
+
+def get_latest_search_key(reply_channel, group=SEARCH_GROUP):
+    if group == SEARCH_GROUP:
+        return LATEST_SEARCH_PREFIX + reply_channel
+    return LATEST_SEARCH_PREFIX + group + ':' + reply_channel
+
+
+def enqueue(function, criteria, session_key, reply_channel, group=SEARCH_GROUP):
+    """
+    Enqueue a job taking (criteria, session_key, reply_channel), superseding
+    any job previously enqueued in the same group for the same reply channel.
+
+    Args:
+        group (str): One of SUPERSESSION_GROUPS
+
+    Returns:
+        Job
+    """
+    connection = settings.REDIS_CONNECTION
+    deadline_in_seconds = get_deadline_in_seconds()
+
+    criteria['search_id'] = uuid.uuid4().hex
+    criteria['deadline'] = time.time() + deadline_in_seconds
+    criteria['supersession_group'] = group
+
+    # Recorded before enqueuing, as the job checks it as soon as it starts
+    previous_search_id = None
+    if reply_channel is not None:
+        latest_search_key = get_latest_search_key(reply_channel, group)
+        previous_search_id = connection.getset(latest_search_key, criteria['search_id'])
+        connection.expire(latest_search_key, deadline_in_seconds)
+
+    queue = Queue(get_queue_name(criteria), connection=connection)
+    job = queue.enqueue(
+        function,
+        args=(criteria, session_key, reply_channel),
+        ttl=deadline_in_seconds,
+        job_id=criteria['search_id'],
+    )
+
+    if previous_search_id is not None:
+        cancel_search(previous_search_id.decode('utf-8'))
+
+    return job
+
+
+def requeue(function, criteria, session_key, reply_channel):
+    """
+    Enqueue a job again, e.g. as the worker running it died, keeping its
+    search id and deadline, so it still yields to newer jobs (see should_run)
+
+    Returns:
+        Job, or None if past the deadline
+    """
+    ttl = int(criteria['deadline'] - time.time())
+    if ttl <= 0:
+        record_dropped_job('deadline')
+        return None
+
+    queue = Queue(get_queue_name(criteria), connection=settings.REDIS_CONNECTION)
+    return queue.enqueue(
+        function,
+        args=(criteria, session_key, reply_channel),
+        ttl=ttl,
+        job_id=criteria['search_id'],
+    )
+
+
+def enqueue_maintenance(function, timeout=600):
+    """
+    Enqueue a rebuild of shared data by a search worker, unless the same
+    function was enqueued within timeout seconds, so that the processes
+    finding the data missing don't each rebuild it.
+
+    Returns:
+        Job, or None if already enqueued
+    """
+    connection = settings.REDIS_CONNECTION
+    lock_key = MAINTENANCE_LOCK_PREFIX + function.__module__ + '.' + function.__name__
+
+    if not connection.set(lock_key, 1, ex=timeout, nx=True):
+        return None
+
+    logger.info('Enqueuing {}'.format(function.__name__))
+    queue = Queue(MAINTENANCE_QUEUE_NAME, connection=connection)
+    return queue.enqueue(function, timeout=timeout)
+
+
+def cancel_job(job_id):
+    """
+    Remove a job from its queue if it hasn't started yet
+    """
+    try:
+        Job.fetch(job_id, connection=settings.REDIS_CONNECTION).cancel()
+    except NoSuchJobError:
+        pass
+
+
+def cancel_search(search_id):
+    """
+    Cancel a search whether it is still queued or already running
+    """
+    cancel_job(search_id)
+    settings.REDIS_CONNECTION.setex(CANCELLED_PREFIX + search_id, get_deadline_in_seconds(), 1)
+
+
+def cancel_client_searches(reply_channel):
+    """
+    Cancel the latest job of each group for a reply channel, e.g. on
+    disconnection
+    """
+    connection = settings.REDIS_CONNECTION
+
+    for group in SUPERSESSION_GROUPS:
+        latest_search_key = get_latest_search_key(reply_channel, group)
+        search_id = connection.get(latest_search_key)
+
+        if search_id is not None:
+            cancel_search(search_id.decode('utf-8'))
+            connection.delete(latest_search_key)
+
+
+def is_cancelled(criteria):
+    if 'search_id' not in criteria:
+        return False
+    return bool(settings.REDIS_CONNECTION.exists(CANCELLED_PREFIX + criteria['search_id']))
+
+
+def record_dropped_job(reason):
+    settings.REDIS_CONNECTION.hincrby(DROPPED_JOBS_KEY, reason, 1)
+
+
+def should_run(criteria, reply_channel):
+    """
+    Checked when a job starts, as it may have waited in the queue.
+
+    Returns:
+        bool: False if the deadline has passed, the search was cancelled or
+        the client has since made another request in the same group
+    """
+    if 'deadline' in criteria and time.time() > criteria['deadline']:
+        logger.info('Dropping search {} past its deadline'.format(criteria['search_id']))
+        record_dropped_job('deadline')
+        return False
+
+    if is_cancelled(criteria):
+        logger.info('Dropping cancelled search {}'.format(criteria['search_id']))
+        record_dropped_job('cancelled')
+        return False
+
+    if 'search_id' in criteria and reply_channel is not None:
+        latest_search_id = settings.REDIS_CONNECTION.get(get_latest_search_key(
+            reply_channel, criteria.get('supersession_group', SEARCH_GROUP)))
+        if latest_search_id is not None and \
+                latest_search_id.decode('utf-8') != criteria['search_id']:
+            logger.info('Dropping search {} superseded by {}'.format(
+                criteria['search_id'], latest_search_id))
+            record_dropped_job('superseded')
+            return False
+
+    return True
+
+
+def render_metrics():
+    """
+    Returns:
+        str: Queue depths and dropped job counts in the Prometheus text format
+    """
+    connection = settings.REDIS_CONNECTION
+
+    queue_depths = [
+        ({'queue': name}, len(Queue(name, connection=connection))) for name in get_queue_names()]
+    dropped_jobs = [
+        ({'reason': reason.decode('utf-8')}, int(count))
+        for reason, count in connection.hgetall(DROPPED_JOBS_KEY).items()]
+
+    return (
+        metrics.render_samples(
+            'search_queue_depth', 'gauge', 'Jobs waiting per queue', queue_depths) +
+        metrics.render_samples(
+            'search_jobs_dropped_total', 'counter', 'Jobs dropped unrun', dropped_jobs))
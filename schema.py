@@ -0,0 +1,188 @@
+"""
+Compact dtypes for the rates, switches and stays passed between search stages.
+
+Columns are typed by name, so the same rules cover every frame: hotel ids as
+int32, counts as int16, costs as float32, dates as datetime64 and other
+repetitive strings (room, board and rate codes) as categoricals. Stages in
+apps.algorithm may widen dtypes again (e.g. ids become floats when a merge
+introduces blanks), so frames are conformed at each stage boundary. Before
+leaving execute.search, frames are converted back to the dtypes the rest of
+the app expects: float64 numbers, plain strings and '%Y-%m-%d' dates.
+
+This is a set of dtype rules rather than a complete schema: frames aren't
+required to have particular columns, but after conforming, columns are
+validated against the kind of values their names imply (see validate), and
+violations are logged, or raised as SchemaViolation in strict mode.
+"""
+import logging
+
+import numpy as np
+from pandas import api, to_datetime
+
+
+logger = logging.getLogger(__name__)
+
+ID_COLUMNS = ['hotel_id', 'hotel_1_id', 'hotel_2_id']
+COUNT_COLUMNS = ['night_count', 'night_count_1', 'night_count_2', 'switch_count']
+DATE_COLUMNS = ['check_in', 'check_in_1', 'check_in_2', 'check_out', 'check_out_1', 'check_out_2']
+EXTRA_COST_COLUMNS = ['switch_benefit', 'max_saving']
+
+DATE_FORMAT = '%Y-%m-%d'
+
+# Object columns are made categorical if they have at most this ratio of
+# distinct values to rows
+MAX_CATEGORICAL_RATIO = 0.5
+
+
+class SchemaViolation(Exception):
+    pass
+
+
+def is_cost_column(column):
+    return 'cost' in column or column in EXTRA_COST_COLUMNS
+
+
+def get_dtype(frame, column):
+    """
+    Returns:
+        The compact dtype for a column, or None to leave it as is
+    """
+    series = frame[column]
+    dtype = series.dtype
+
+    if column in ID_COLUMNS or column in COUNT_COLUMNS:
+        if not api.types.is_numeric_dtype(dtype) or series.isnull().any():
+            return None
+        int_dtype = np.int32 if column in ID_COLUMNS else np.int16
+        if len(series) > 0 and not (np.iinfo(int_dtype).min <= series.min() and
+                                    series.max() <= np.iinfo(int_dtype).max):
+            return None
+        return int_dtype
+
+    if column in DATE_COLUMNS:
+        return 'datetime64[ns]' if dtype == object else None
+
+    if api.types.is_float_dtype(dtype) and is_cost_column(column):
+        return np.float32
+
+    if dtype == object and len(series) > 0:
+        if series.nunique() <= MAX_CATEGORICAL_RATIO * len(series):
+            return 'category'
+
+    return None
+
+
+def validate(frame):
+    """
+    Check columns hold the kind of values their names imply. Missing ids and
+    counts are allowed, as merges may introduce blanks.
+
+    Returns:
+        list: Descriptions of violations
+    """
+    violations = []
+
+    for column in frame.columns:
+        dtype = frame[column].dtype
+
+        if column in ID_COLUMNS or column in COUNT_COLUMNS:
+            if not api.types.is_numeric_dtype(dtype):
+                violations.append('{} is {}, not numeric'.format(column, dtype))
+            elif api.types.is_integer_dtype(dtype):
+                int_dtype = np.int32 if column in ID_COLUMNS else np.int16
+                if len(frame) > 0 and (frame[column].min() < np.iinfo(int_dtype).min or
+                                       frame[column].max() > np.iinfo(int_dtype).max):
+                    violations.append('{} is out of the {} range'.format(
+                        column, np.dtype(int_dtype)))
+        elif column in DATE_COLUMNS:
+            if not api.types.is_datetime64_any_dtype(dtype):
+                violations.append('{} is {}, not dates'.format(column, dtype))
+        elif is_cost_column(column):
+            if not api.types.is_numeric_dtype(dtype):
+                violations.append('{} is {}, not numeric'.format(column, dtype))
+
+    return violations
+
+
+def conform(frame, stage, strict=False):
+    """
+    Convert columns to their compact dtypes where a stage has left them
+    wider, then validate them.
+
+    Args:
+        strict (bool): Raise SchemaViolation rather than log violations
+
+    Returns:
+        DataFrame
+    """
+    frame = convert(frame, stage)
+
+    violations = validate(frame)
+    if violations:
+        message = 'Schema violated after {}: {}'.format(stage, '; '.join(violations))
+        if strict:
+            raise SchemaViolation(message)
+        logger.warning(message)
+
+    return frame
+
+
+def convert(frame, stage):
+    """
+    Returns:
+        DataFrame: With columns converted to their compact dtypes where they
+        were wider, leaving dates which don't parse for validate to report
+    """
+    conversions = {}
+    for column in frame.columns:
+        dtype = get_dtype(frame, column)
+        if dtype is not None and frame[column].dtype != dtype:
+            conversions[column] = dtype
+
+    if not conversions:
+        return frame
+
+    logger.debug('Conforming after {}: {}'.format(
+        stage, ', '.join('{} {} -> {}'.format(column, frame[column].dtype, dtype)
+                         for column, dtype in sorted(conversions.items(), key=str))))
+
+    frame = frame.copy()
+    for column, dtype in conversions.items():
+        if dtype == 'datetime64[ns]':
+            try:
+                frame[column] = to_datetime(frame[column], format=DATE_FORMAT)
+            except ValueError:
+                pass
+        else:
+            frame[column] = frame[column].astype(dtype)
+
+    return frame
+
+
+def to_output(frame, date_columns=DATE_COLUMNS):
+    """
+    Convert compact dtypes back to those expected outside the search pipeline.
+
+    Args:
+        date_columns (list): Datetime columns to format as strings, i.e.
+            those which were strings before being conformed
+
+    Returns:
+        DataFrame
+    """
+    frame = frame.copy()
+
+    for column in frame.columns:
+        dtype = frame[column].dtype
+
+        if api.types.is_categorical_dtype(dtype):
+            frame[column] = frame[column].astype(object)
+        elif column in date_columns and api.types.is_datetime64_any_dtype(dtype):
+            dates = frame[column]
+            frame[column] = dates.dt.strftime(DATE_FORMAT).where(dates.notnull(), None)
+        elif dtype == np.float32:
+            frame[column] = frame[column].astype(np.float64)
+        elif dtype in (np.int32, np.int16):
+            frame[column] = frame[column].astype(np.int64)
+
+    return frame
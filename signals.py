@@ -0,0 +1,43 @@
+"""
+Invalidation of the search app's process-wide caches. Changed hotels are
+logged (see hotel_changes) and other caches keep a version number in the
+shared Django cache, so a change saved by any process (web, worker or
+management command) is picked up by every worker.
+"""
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from apps.apis.models import HotelbedsRoom, HotelbedsBoard, HotelbedsFacility
+from apps.metadata.models import Hotel
+from apps.search import hotel_changes, reference, suggestions
+
+
+# TrustYou data is shown on hotel cards too. The model is taken from the
+# relation, as field.related_model requires the registry to be ready
+TrustYou = Hotel._meta.get_field('trustyou').remote_field.model
+
+
+@receiver([post_save, post_delete], sender=Hotel)
+def record_hotel_change(sender, instance, **kwargs):
+    hotel_changes.record([instance.hotel_id])
+
+
+# Deletions are recorded before the hotels are detached from the TrustYou data
+@receiver([post_save, pre_delete], sender=TrustYou)
+def record_trustyou_change(sender, instance, **kwargs):
+    hotel_changes.record(
+        Hotel.objects.filter(trustyou=instance).values_list('hotel_id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=HotelbedsRoom)
+@receiver([post_save, post_delete], sender=HotelbedsBoard)
+@receiver([post_save, post_delete], sender=HotelbedsFacility)
+def invalidate_reference_data(sender, **kwargs):
+    # Memoised facility lists of changed hotels are evicted via hotel_changes
+    reference.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Hotel)
+def mark_suggested_cities_stale(sender, **kwargs):
+    # Rebuilt by the build_suggested_cities command, not on every change
+    suggestions.mark_stale()
@@ -0,0 +1,491 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pickle
+import struct
+import tempfile
+import time
+import uuid
+import zlib
+
+import msgpack
+import numpy as np
+from django.conf import settings
+from pandas import Categorical, DataFrame, Index, RangeIndex, Series, Timestamp, api, to_datetime
+
+
+logger = logging.getLogger(__name__)
+
+SESSION_RESULT_EXPIRY_KEY = 'search:session-results:expiry'
+
+# Removes members of a sorted set whose score is at most ARGV[1], atomically
+REMOVE_EXPIRED_SCRIPT = """
+local removed = 0
+for i = 2, #ARGV do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if score and tonumber(score) <= tonumber(ARGV[1]) then
+        removed = removed + redis.call('ZREM', KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+# Fields parsed as dates when stays were held in the session as JSON, and
+# which the stay detail template still expects as dates
+STAY_DATE_FIELDS = ['cancellation_deadline', 'cancellation_deadline_1', 'cancellation_deadline_2']
+
+# msgpack extension types for values within object columns
+DATETIME_EXT = 1
+DATE_EXT = 2
+PICKLE_EXT = 3
+
+
+class RedisBackend(object):
+    """
+    Keep serialised results in Redis, relying on key expiry for the TTL
+    """
+    prefix = 'search:results:'
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def set(self, key, value, ttl):
+        self.connection.setex(self.prefix + key, int(ttl), value)
+
+    def get(self, key):
+        return self.connection.get(self.prefix + key)
+
+    def delete(self, key):
+        self.connection.delete(self.prefix + key)
+
+    def set_index(self, key, records, ttl):
+        index_key = self.prefix + key + ':index'
+        pipeline = self.connection.pipeline()
+        pipeline.delete(index_key)
+        if records:
+            pipeline.hmset(index_key, records)
+        pipeline.expire(index_key, int(ttl))
+        pipeline.execute()
+
+    def get_index(self, key, field):
+        return self.connection.hget(self.prefix + key + ':index', field)
+
+    def touch(self, key, ttl):
+        pipeline = self.connection.pipeline()
+        pipeline.expire(self.prefix + key, int(ttl))
+        pipeline.expire(self.prefix + key + ':index', int(ttl))
+        pipeline.execute()
+
+
+class FileBackend(object):
+    """
+    Keep serialised results on the local filesystem. Suitable for single-dyno
+    deployments and development. The expiry time is stored as the file's
+    modification time, so no separate metadata is required.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        # Keys contain place names, commas and slashes, so hash for filenames
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def set(self, key, value, ttl):
+        path = self.path(key)
+        expires_at = time.time() + ttl
+
+        # Write then rename so that readers never see a partial file
+        temporary_path = path + '.tmp{}'.format(os.getpid())
+        with open(temporary_path, 'wb') as f:
+            f.write(value)
+        os.utime(temporary_path, (expires_at, expires_at))
+        os.replace(temporary_path, path)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            if os.path.getmtime(path) < time.time():
+                self.delete(key)
+                return None
+
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def delete(self, key):
+        for path in [self.path(key), self.path(key) + '.index']:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def set_index(self, key, records, ttl):
+        # Layout: header length, pickled {field: (offset, length)}, records.
+        # Readers load the small header and seek to a single record
+        offsets = {}
+        position = 0
+        for field, record in records.items():
+            offsets[field] = (position, len(record))
+            position += len(record)
+        header = pickle.dumps(offsets, protocol=pickle.HIGHEST_PROTOCOL)
+
+        path = self.path(key) + '.index'
+        expires_at = time.time() + ttl
+
+        temporary_path = path + '.tmp{}'.format(os.getpid())
+        with open(temporary_path, 'wb') as f:
+            f.write(struct.pack('>Q', len(header)))
+            f.write(header)
+            for record in records.values():
+                f.write(record)
+        os.utime(temporary_path, (expires_at, expires_at))
+        os.replace(temporary_path, path)
+
+    def get_index(self, key, field):
+        path = self.path(key) + '.index'
+        try:
+            if os.path.getmtime(path) < time.time():
+                self.delete(key)
+                return None
+
+            with open(path, 'rb') as f:
+                header_length, = struct.unpack('>Q', f.read(8))
+                offsets = pickle.loads(f.read(header_length))
+                if field not in offsets:
+                    return None
+                offset, length = offsets[field]
+                f.seek(8 + header_length + offset)
+                return f.read(length)
+        except OSError:
+            return None
+
+    def touch(self, key, ttl):
+        expires_at = time.time() + ttl
+        for path in [self.path(key), self.path(key) + '.index']:
+            try:
+                os.utime(path, (expires_at, expires_at))
+            except OSError:
+                pass
+
+
+def get_backend():
+    backend = getattr(settings, 'RESULT_STORE_BACKEND', 'redis')
+
+    if backend == 'file':
+        directory = getattr(
+            settings, 'RESULT_STORE_DIRECTORY',
+            os.path.join(tempfile.gettempdir(), 'search-results'))
+        return FileBackend(directory)
+
+    return RedisBackend(settings.REDIS_CONNECTION)
+
+
+def pack_object(value):
+    if isinstance(value, datetime.datetime):  # Including Timestamp
+        return msgpack.ExtType(DATETIME_EXT, value.isoformat().encode('utf-8'))
+    if isinstance(value, datetime.date):
+        return msgpack.ExtType(DATE_EXT, value.isoformat().encode('utf-8'))
+    if isinstance(value, np.generic):
+        return value.item()
+    return msgpack.ExtType(PICKLE_EXT, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def unpack_object(code, data):
+    if code == DATETIME_EXT:
+        return Timestamp(data.decode('utf-8'))
+    if code == DATE_EXT:
+        return datetime.datetime.strptime(data.decode('utf-8'), '%Y-%m-%d').date()
+    if code == PICKLE_EXT:
+        return pickle.loads(data)
+    return msgpack.ExtType(code, data)
+
+
+def pack_column(values):
+    """
+    Numeric, boolean and datetime columns are kept as raw numpy buffers,
+    categoricals as their categories and codes, and anything else as a list
+    """
+    dtype = values.dtype
+
+    if api.types.is_categorical_dtype(dtype):
+        return {
+            'kind': 'categorical',
+            'categories': pack_column(Series(dtype.categories)),
+            'codes': pack_column(Series(values.cat.codes)),
+            'ordered': bool(dtype.ordered),
+        }
+
+    if isinstance(dtype, np.dtype) and dtype.kind in 'biufcmM':
+        array = np.ascontiguousarray(values.values)
+        return {'kind': 'numpy', 'dtype': array.dtype.str, 'data': array.tobytes()}
+
+    return {'kind': 'object', 'values': values.tolist()}
+
+
+def unpack_column(column):
+    if column['kind'] == 'categorical':
+        categories = unpack_column(column['categories'])
+        codes = unpack_column(column['codes'])
+        return Categorical.from_codes(codes, categories, ordered=column['ordered'])
+
+    if column['kind'] == 'numpy':
+        # Copied, as arrays backed by the message buffer are read-only
+        return np.frombuffer(column['data'], dtype=np.dtype(column['dtype'])).copy()
+
+    return column['values']
+
+
+def pack_frame(frame):
+    """
+    Serialise a frame column by column with msgpack and compress it with
+    zlib. Unlike pandas' own (experimental, since removed) msgpack support,
+    the format only depends on numpy buffers and msgpack itself.
+
+    Returns:
+        bytes
+    """
+    index = frame.index
+    default_index = isinstance(index, RangeIndex) and index.start == 0 and index.step == 1
+
+    message = {
+        'columns': list(frame.columns),
+        'data': [pack_column(frame.iloc[:, position]) for position in range(frame.shape[1])],
+        'index': None if default_index else pack_column(Series(index)),
+    }
+
+    return zlib.compress(msgpack.packb(message, use_bin_type=True, default=pack_object))
+
+
+def unpack_frame(data):
+    """
+    Returns:
+        DataFrame: As passed to pack_frame
+    """
+    message = msgpack.unpackb(zlib.decompress(data), raw=False, ext_hook=unpack_object)
+
+    index = None
+    if message['index'] is not None:
+        index = Index(unpack_column(message['index']))
+
+    columns = [unpack_column(column) for column in message['data']]
+    frame = DataFrame(
+        dict(zip(range(len(columns)), columns)), columns=range(len(columns)), index=index)
+    frame.columns = message['columns']
+
+    return frame
+
+
+def save_stays(key, stays, ttl=None):
+    """
+    Store a complete result set (including lengthy rateKey information) for
+    later use in the stay detail view. Frames are serialised column-wise (see
+    pack_frame), which is far more compact and faster to load than JSON and
+    preserves dtypes, so dates don't need to be re-parsed.
+
+    Args:
+        key (str): See utils.create_session_key
+        stays (DataFrame)
+        ttl (int): Seconds until expiry; defaults to MAXIMUM_RESULT_AGE_IN_SECONDS
+
+    Returns:
+        str: Generation of the result set, which changes whenever the key is
+        saved again, so copies held elsewhere can be checked (see get_generation)
+    """
+    if ttl is None:
+        ttl = settings.MAXIMUM_RESULT_AGE_IN_SECONDS
+
+    generation = uuid.uuid4().hex
+
+    backend = get_backend()
+    backend.set(key, pack_frame(stays), ttl)
+    backend.set_index(key, index_stays(stays), ttl)
+    # Written last, so a reader never pairs it with the previous result set
+    backend.set(key + ':generation', generation.encode('utf-8'), ttl)
+
+    return generation
+
+
+def get_generation(key):
+    """
+    Returns:
+        str: Generation of the stored result set, or None if it has expired
+    """
+    generation = get_backend().get(key + ':generation')
+
+    if generation is None:
+        return None
+
+    return generation.decode('utf-8')
+
+
+def touch(key, ttl=None):
+    """
+    Extend the life of a stored result set, e.g. when it is shared with
+    another user whose session pointer is newer than the result set itself
+    """
+    if ttl is None:
+        ttl = settings.MAXIMUM_RESULT_AGE_IN_SECONDS
+
+    backend = get_backend()
+    backend.touch(key, ttl)
+    backend.touch(key + ':generation', ttl)
+
+
+def load_stays(key):
+    """
+    Returns:
+        DataFrame, or None if the result set has expired or never existed
+    """
+    data = get_backend().get(key)
+
+    if data is None:
+        return None
+
+    return unpack_frame(data)
+
+
+def get_candidate_ttl():
+    # Candidates are only refined while the client is on the results page
+    return getattr(settings, 'SEARCH_CANDIDATE_TTL', 1800)
+
+
+def get_max_candidate_bytes():
+    # Well within Redis's 512 MB limit on values
+    return getattr(settings, 'SEARCH_CANDIDATE_MAX_BYTES', 128 * 1024 * 1024)
+
+
+def save_candidates(key, rates, stays, ttl=None):
+    """
+    Store the rates and unfiltered stays of a search, so that results can be
+    refined with other filters or sort orders without searching again.
+
+    Returns:
+        bool: False if they were too large to store
+    """
+    if ttl is None:
+        ttl = get_candidate_ttl()
+
+    packed_rates = pack_frame(rates)
+    packed_stays = pack_frame(stays)
+
+    if len(packed_rates) + len(packed_stays) > get_max_candidate_bytes():
+        logger.warning('Candidates for {} are too large to store ({} bytes)'.format(
+            key, len(packed_rates) + len(packed_stays)))
+        return False
+
+    backend = get_backend()
+    backend.set(key + ':candidates:rates', packed_rates, ttl)
+    backend.set(key + ':candidates:stays', packed_stays, ttl)
+
+    return True
+
+
+def load_candidates(key):
+    """
+    Returns:
+        tuple: (rates, stays), or None if either has expired
+    """
+    backend = get_backend()
+    rates = backend.get(key + ':candidates:rates')
+    stays = backend.get(key + ':candidates:stays')
+
+    if rates is None or stays is None:
+        return None
+
+    return unpack_frame(rates), unpack_frame(stays)
+
+
+def stay_index_field(hotel_1_id, hotel_2_id=0, check_in_2=None):
+    """
+    Standard (non-switching) stays are indexed with a hotel_2_id of 0 and no
+    second check-in, matching the kwargs of the standard_stay url.
+    """
+    return '{}|{}|{}'.format(int(hotel_1_id), int(hotel_2_id or 0), check_in_2 or '')
+
+
+def index_stays(stays):
+    """
+    Serialise each stay individually, keyed by (hotel_1_id, hotel_2_id,
+    check_in_2), so the stay detail view can fetch a single record. Stays are
+    already sorted, so where a key repeats the first stay is kept, as per the
+    previous query-based lookup.
+
+    Returns:
+        dict: Index field to pickled stay record
+    """
+    index = {}
+
+    for stay in stays.to_dict('records'):
+        if stay.get('switch_count', 0) > 0:
+            field = stay_index_field(stay['hotel_1_id'], stay['hotel_2_id'], stay['check_in_2'])
+        else:
+            field = stay_index_field(stay['hotel_1_id'])
+
+        if field not in index:
+            index[field] = pickle.dumps(stay, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return index
+
+
+def load_stay(key, hotel_1_id, hotel_2_id=0, check_in_2=None):
+    """
+    Returns:
+        dict: A single stay record, or None if expired or not found
+    """
+    record = get_backend().get_index(key, stay_index_field(hotel_1_id, hotel_2_id, check_in_2))
+
+    if record is None:
+        return None
+
+    stay = pickle.loads(record)
+    for field in STAY_DATE_FIELDS:
+        if field in stay:
+            stay[field] = to_datetime(stay[field])
+
+    return stay
+
+
+def index_session_result(session_key, search_key, ttl=None):
+    """
+    Record when a session's pointer to a result set expires, so that the
+    purge only needs to visit expired entries. Re-indexing the same pointer
+    moves its expiry.
+    """
+    if ttl is None:
+        ttl = settings.MAXIMUM_RESULT_AGE_IN_SECONDS
+
+    settings.REDIS_CONNECTION.zadd(
+        SESSION_RESULT_EXPIRY_KEY, {json.dumps([session_key, search_key]): time.time() + ttl})
+
+
+def get_expired_session_results(now, count=1000):
+    """
+    Returns:
+        list: Up to count (session_key, search_key) tuples expired by now
+    """
+    members = settings.REDIS_CONNECTION.zrangebyscore(
+        SESSION_RESULT_EXPIRY_KEY, '-inf', now, start=0, num=count)
+
+    return [tuple(json.loads(member.decode('utf-8'))) for member in members]
+
+
+def remove_session_results_from_index(session_results, now):
+    """
+    Remove entries still expired by now, leaving any re-indexed since they
+    were read, as their pointers have been refreshed.
+
+    Returns:
+        int: Number of entries removed
+    """
+    if not session_results:
+        return 0
+
+    remove_expired = settings.REDIS_CONNECTION.register_script(REMOVE_EXPIRED_SCRIPT)
+
+    return remove_expired(
+        keys=[SESSION_RESULT_EXPIRY_KEY],
+        args=[now] + [json.dumps(list(item)) for item in session_results])
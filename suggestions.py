@@ -0,0 +1,166 @@
+"""
+Suggested cities for places with too many hotels to search at once.
+
+For each country, state and county with at least the maximum hotel count for
+its level, the cities with the most hotels are suggested instead. Aggregating
+the whole Hotel table is far too slow for a request, so suggestions are built
+by the build_suggested_cities command and shared via the Django cache, and
+each process keeps them in memory until the version changes. Hotel changes
+only mark the suggestions as stale (see signals), to be rebuilt by the next
+run of the command with --if-stale. If they are missing altogether, requests
+go without suggestions while a search worker builds them.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from pandas import DataFrame
+
+from apps.metadata.models import Hotel
+from apps.search import scheduling
+
+
+logger = logging.getLogger(__name__)
+
+SUGGESTIONS_KEY = 'suggested_cities'
+VERSION_KEY = 'suggested_cities_version'
+STALE_KEY = 'suggested_cities_stale'
+
+# Level to the Hotel fields identifying a place at that level
+LEVELS = OrderedDict([
+    ('country', ['iso_alpha_2_country_code']),
+    ('state', ['iso_alpha_2_country_code', 'state']),
+    ('county', ['iso_alpha_2_country_code', 'state', 'county']),
+])
+
+
+def get_version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def mark_stale():
+    cache.set(STALE_KEY, 1, None)
+
+
+def is_stale():
+    return bool(cache.get(STALE_KEY))
+
+
+def get_maximum_hotel_count(level):
+    # Defaults to the country limit, as the oversize state and county
+    # aggregations were originally sketched
+    return getattr(
+        settings, 'MAXIMUM_{}_HOTEL_COUNT'.format(level.upper()),
+        settings.MAXIMUM_COUNTRY_HOTEL_COUNT)
+
+
+def load_city_counts():
+    """
+    Returns:
+        DataFrame: Hotel count per city, with the fields of every level
+    """
+    fields = LEVELS['county'] + ['city']
+    city_counts = (
+        Hotel.objects.values(*fields)
+        .annotate(hotel_count=Count('hotel_id'))
+        .order_by())
+
+    return DataFrame(list(city_counts.iterator()), columns=fields + ['hotel_count'])
+
+
+def suggest_cities(city_counts, level):
+    """
+    Returns:
+        dict: {rank: city} for the largest cities of each oversize place,
+        keyed by country code, or by a tuple of the level's fields below
+        country level
+    """
+    place_fields = LEVELS[level]
+
+    place_hotel_counts = city_counts.groupby(place_fields)['hotel_count'].transform('sum')
+    city_counts = city_counts[place_hotel_counts >= get_maximum_hotel_count(level)]
+
+    if len(city_counts) == 0:
+        return {}
+
+    # Cities may span several counties
+    city_counts = city_counts.groupby(place_fields + ['city'])['hotel_count'].sum().reset_index()
+    city_counts = city_counts.sort_values(place_fields + ['hotel_count'], ascending=False)
+
+    suggested_cities = city_counts.groupby(place_fields).head(settings.SUGGESTED_CITY_COUNT)
+    suggested_cities = suggested_cities.assign(
+        rank=suggested_cities.groupby(place_fields).cumcount() + 1)
+
+    suggested_cities = suggested_cities.set_index(place_fields + ['rank'])['city'].unstack('rank')
+
+    return suggested_cities.to_dict('index')
+
+
+def build():
+    """
+    Aggregate the Hotel table and share the suggestions via the Django cache.
+
+    Returns:
+        dict: Suggestions for each of LEVELS
+    """
+    start_time = time.time()
+
+    # Cleared first, so changes made while building mark the result stale
+    cache.delete(STALE_KEY)
+
+    city_counts = load_city_counts()
+    suggestions = {level: suggest_cities(city_counts, level) for level in LEVELS}
+
+    cache.set(SUGGESTIONS_KEY, suggestions, None)
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+
+    logger.info('Built suggested cities for {} in {:.1f}s'.format(
+        ', '.join('{} {}s'.format(len(suggestions[level]), level) for level in LEVELS),
+        time.time() - start_time))
+
+    return suggestions
+
+
+class SuggestedCities(object):
+    def __init__(self):
+        self.version = None
+        self.suggestions = None
+
+    def check_validity(self):
+        version = get_version()
+        if self.suggestions is not None and version == self.version:
+            return
+
+        suggestions = cache.get(SUGGESTIONS_KEY)
+
+        if suggestions is None:
+            # Not yet built (or evicted). Never built on a request, as
+            # aggregating the Hotel table takes far too long
+            logger.warning('Suggested cities missing; '
+                           'schedule the build_suggested_cities command')
+            scheduling.enqueue_maintenance(build)
+            return
+
+        self.suggestions = suggestions
+        self.version = version
+
+    def get(self, level='country'):
+        """
+        Returns:
+            dict: See suggest_cities
+        """
+        self.check_validity()
+
+        if self.suggestions is None:
+            return {}
+
+        return self.suggestions[level]
+
+
+suggested_cities = SuggestedCities()
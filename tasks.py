@@ -5,7 +5,6 @@ from django.conf import settings
 from django.contrib.sessions.backends.db import SessionStore
 from django.db import transaction
 from django.db.models import F
-import json
 import logging
 from math import ceil, floor
 from pandas import DataFrame, datetime, date_range, DateOffset, melt
@@ -20,17 +19,54 @@ from raven.transport.http import HTTPTransport
 django.setup()
 
 from apps.apis.exceptions import RequestError, NoResultsError  # noqa
-from apps.metadata.models import Hotel  # noqa
-from apps.search import execute, utils  # noqa
+from apps.search import (  # noqa
+    coalesce, encoding, execute, pagination, prefetch, refinement, scheduling, store, utils)
+from apps.search.hotel_cards import hotel_card_cache  # noqa
 from apps.search.models import LatestSaving  # noqa
 
 
 logger = logging.getLogger(__name__)
 client = Client(os.getenv('SENTRY_DSN', ''), transport=HTTPTransport)
 
+FIELDS_REQUIRED_ON_RESULTS_PAGE = [
+    'default_sort',
+    'hotel_1_id',
+    'check_in_1',
+    'night_count_1',
+    'entire_stay_cost_1',
+    'hotel_2_id',
+    'night_count_2',
+    'entire_stay_cost_2',
+    'switch_count',
+    'distance_in_km',
+    'rounded_stay_cost',
+    'rounded_nightly_cost',
+    'benchmark_stay_cost',
+    'primary_star_rating',
+    'review_score',
+    'min_review_tier',
+    'primary_review_tier',
+    'refundable',
+]
+
+REQUIRED_FIELDS_ONLY_PRESENT_IN_MULTI_NIGHT_SEARCH = [
+    'check_in_2',
+    'cost_delta_vs_stay_benchmark',
+    'percentage_cost_delta_vs_stay_benchmark',
+    'switch_benefit',
+]
+
 
 def execute_search(criteria, session_key, reply_channel):
     run_from_management_command = criteria.get('data_mining')
+    is_prefetch = criteria.get('prefetch')
+
+    # Jobs may have waited in the queue past their usefulness
+    if not scheduling.should_run(criteria, reply_channel):  # pragma: no cover
+        return
+
+    # As enqueued, for the search to be re-run if it waits on one that dies
+    job_criteria = dict(criteria)
 
     # Check-in range pre-calculated when running analytics
     if not run_from_management_command:  # pragma: no cover
@@ -38,21 +74,21 @@ def execute_search(criteria, session_key, reply_channel):
         check_out = datetime.strptime(criteria['checkOut'], '%Y-%m-%d')
         criteria['check_in_range'] = date_range(check_in, check_out - DateOffset(days=1))
 
-    night_count = len(criteria['check_in_range'])
+    outbound_message = create_outbound_message(criteria)
 
-    outbound_message = {
-        'status': '200',
-        'currency': criteria['currency'],
-        'currency_symbol': settings.CURRENCY_SYMBOLS[criteria['currency']],
-        'country': criteria['country'],  # Blank if not country search
-        'night_count': night_count,
-    }
+    # Replies go to the requesting channel plus anyone who made an identical
+    # search while this one was in flight. Prefetches only fill the cache
+    recipients = [(session_key, reply_channel, get_reply_options(criteria))]
+    if is_prefetch:  # pragma: no cover
+        recipients = []
+    result_key = None
+    holds_in_flight_lock = False
+    results = None
+    candidates = None
+    generation = None
 
     try:
-        criteria['city'] = unquote(criteria['city'])
-        criteria['county'] = unquote(criteria['county'])
-        criteria['state'] = unquote(criteria['state'])
-        criteria['country'] = unquote(criteria['country'])
+        unquote_place(criteria)
 
         if criteria['country'] in settings.BLOCKED_COUNTRIES:
             # We no longer permit searches for certain high-risk countries due
@@ -66,62 +102,47 @@ def execute_search(criteria, session_key, reply_channel):
                 .format(criteria['country']))
             raise Exception
 
-        _, stays = execute.search(criteria)
-
-        if not run_from_management_command:  # pragma: no cover
-            search_key = utils.create_session_key(
-                unquote(criteria['place_name']),
-                criteria['checkIn'],
-                criteria['checkOut'],
-                criteria['occupants'],
-                criteria['latitude'],
-                criteria['longitude'],
-                criteria['currency'],
-            )
-
-            # Store complete record (including lengthy rateKey information) for
-            # later use in stay detail view
-            http_session = SessionStore(session_key=session_key)
-
-            http_session[search_key] = {
-                'stays': stays.to_json(),
-                'timestamp': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-            }
-
-            http_session.save()
-
-        fields_required_on_results_page = [
-            'default_sort',
-            'hotel_1_id',
-            'check_in_1',
-            'night_count_1',
-            'entire_stay_cost_1',
-            'hotel_2_id',
-            'night_count_2',
-            'entire_stay_cost_2',
-            'switch_count',
-            'distance_in_km',
-            'rounded_stay_cost',
-            'rounded_nightly_cost',
-            'benchmark_stay_cost',
-            'primary_star_rating',
-            'review_score',
-            'min_review_tier',
-            'primary_review_tier',
-            'refundable',
-        ]
-
-        required_fields_only_present_in_multi_night_search = [
-            'check_in_2',
-            'cost_delta_vs_stay_benchmark',
-            'percentage_cost_delta_vs_stay_benchmark',
-            'switch_benefit',
-        ]
-
-        if stays['switch_count'].max() > 0:  # pragma: no cover
-            fields_required_on_results_page = \
-                fields_required_on_results_page + required_fields_only_present_in_multi_night_search
-
+        if run_from_management_command:  # pragma: no cover
+            _, stays = execute.search(criteria)
+        else:  # pragma: no cover
+            result_key = utils.create_result_key(criteria)
+            stays = coalesce.get_cached_stays(result_key)
+
+            if stays is not None:
+                if is_prefetch:
+                    return
+                prefetch.record_if_hit(result_key)
+
+            if stays is None:
+                holds_in_flight_lock = coalesce.acquire(result_key)
+
+                if not holds_in_flight_lock:
+                    if is_prefetch:
+                        return
+                    if coalesce.add_waiter(result_key, job_criteria, session_key,
+                                           reply_channel, get_reply_options(criteria)):
+                        # The identical in-flight search will reply for us
+                        return
+                    stays = coalesce.get_cached_stays(result_key)
+
+            if stays is None:
+                # Only abandon the search if nobody else is waiting on it
+                def is_cancelled():
+                    return scheduling.is_cancelled(criteria) and \
+                        not coalesce.has_waiters(result_key)
+
+                # Candidates are kept so that results can be refined cheaply
+                _, stays, candidates = execute.search_with_candidates(
+                    criteria, is_cancelled=is_cancelled)
+
+                # Store complete record (including lengthy rateKey information)
+                # for later use in stay detail view and identical searches
+                generation = coalesce.cache_stays(result_key, stays)
+                if is_prefetch:
+                    prefetch.mark_prefetched(result_key)
+
+        # Prefetches aren't searches anyone made, so don't feature on the ticker
+        if stays['switch_count'].max() > 0 and not is_prefetch:  # pragma: no cover
             max_saving = abs(stays['percentage_cost_delta_vs_stay_benchmark'].min())
             if max_saving >= 0.3:
                 log_max_saving(criteria, max_saving)
@@ -129,60 +150,14 @@ def execute_search(criteria, session_key, reply_channel):
         if run_from_management_command:  # pragma: no cover
             # Hotel info not required; pass back to calling command
             fields_required_for_data_mining = ['stay_cost', 'cost_per_quality_unit']
-            fields_required_on_results_page = \
-                fields_required_on_results_page + fields_required_for_data_mining
-            return stays[fields_required_on_results_page]
-
-        outbound_message['stays'] = \
-            stays[fields_required_on_results_page].to_json(orient='records')
-
-        hotel_id_columns = stays.columns.str.contains('hotel_[\d]_id')
-        hotel_ids = melt(stays.loc[:, hotel_id_columns]).dropna()['value'].unique()
-
-        hotels = Hotel.objects.filter(hotel_id__in=hotel_ids).select_related().iterator()
-
-        hotels = [{
-            'hotel_id': str(hotel.hotel_id),  # String required for use as key
-            'name': hotel.name,
-            'star_rating': hotel.star_rating,
-            'main_image_url': hotel.main_image_url,
-            'recommendations': hotel.trustyou.recommendations,
-            'summary': hotel.trustyou.summary,
-            'trust_score': hotel.trustyou.trust_score,
-            'trust_score_description': hotel.trustyou.trust_score_description,
-            'review_count': hotel.trustyou.review_count,
-            'category_badge': hotel.trustyou.category_badge,
-            'latitude': hotel.latitude,
-            'longitude': hotel.longitude,
-        } for hotel in hotels]
-
-        hotels = DataFrame(hotels)
-        hotels.set_index('hotel_id', inplace=True)
-
-        outbound_message['hotels'] = hotels.to_dict('index')
-
-        min_stay_cost = stays['stay_cost'].min()
-        max_stay_cost = stays['stay_cost'].max()
-        try:  # pragma: no cover
-            min_switch_distance = int(stays['distance_in_km'].min())
-            max_switch_distance = int(stays['distance_in_km'].max())
-        except ValueError:
-            min_switch_distance = 0
-            max_switch_distance = 0
-        min_nightly_cost = min_stay_cost / night_count
-        max_nightly_cost = max_stay_cost / night_count
-
-        outbound_message['cost_ranges'] = {
-            'minStayCost': floor(min_stay_cost),
-            'maxStayCost': ceil(max_stay_cost),
-            'minNightlyCost': floor(min_nightly_cost),
-            'maxNightlyCost': ceil(max_nightly_cost),
-        }
-
-        outbound_message['distance_ranges'] = {
-            'minDistanceSwitch': min_switch_distance,
-            'maxDistanceSwitch': max_switch_distance,
-        }
+            return stays[get_result_fields(stays) + fields_required_for_data_mining]
+
+        results = describe_results(stays, outbound_message)
+
+    except scheduling.SearchCancelled:  # pragma: no cover
+        # Client closed the request
+        outbound_message['status'] = '499'
+        scheduling.record_dropped_job('cancelled')
 
     except (RequestError, NoResultsError):
         error = 'RequestError or NoResultsError when searching for {}'.format(
@@ -205,16 +180,400 @@ def execute_search(criteria, session_key, reply_channel):
         if run_from_management_command:
             return DataFrame()
 
-    if reply_channel is not None:  # pragma: no cover
-        # This is actually tested but coverage cant detect it
-        Channel(reply_channel).send({
-            "text": json.dumps(outbound_message)
-        })
+    if holds_in_flight_lock:  # pragma: no cover
+        recipients = recipients + coalesce.release(result_key)
+
+    for recipient_session_key, recipient_reply_channel, options in recipients:
+        recipient_result_key, recipient_message, recipient_results = \
+            result_key, outbound_message, results
+
+        # Recipients in a filter variant get results refined from the shared search
+        if outbound_message['status'] == '200' and options.get('filter_variant'):
+            try:  # pragma: no cover
+                recipient_result_key, recipient_message, recipient_results = refine_results(
+                    criteria, result_key, outbound_message,
+                    refinement.get_filter_parameters(options['filter_variant']),
+                    candidates=candidates)
+            except Exception:  # pragma: no cover
+                # Other recipients are still replied to, and this one gets
+                # the unrefined results
+                logger.exception('Unable to apply filter variant {} to {}'.format(
+                    options['filter_variant'], result_key))
+                recipient_result_key, recipient_message, recipient_results = \
+                    result_key, outbound_message, results
+
+        if outbound_message['status'] == '200' and not run_from_management_command:
+            save_result_pointer(  # pragma: no cover
+                criteria, recipient_session_key, recipient_result_key)
+
+        if recipient_reply_channel is not None:  # pragma: no cover
+            # This is actually tested but coverage cant detect it
+            send_results(recipient_reply_channel, recipient_message, recipient_results, options)
+
+    # Stored after replying, as serialising the largest frames is slow. Not
+    # for prefetches, which are rarely refined (see refine_search)
+    if candidates is not None and not is_prefetch:  # pragma: no cover
+        try:
+            store.save_candidates(
+                refinement.get_candidates_key(result_key, generation), *candidates)
+        except Exception:
+            logger.exception('Unable to store candidates for {}'.format(result_key))
 
     if outbound_message['status'] == '200':
+        if not run_from_management_command:  # pragma: no cover
+            prefetch.schedule(execute_search, criteria, session_key, reply_channel)
         return True
 
 
+def refine_search(criteria, session_key, reply_channel):
+    """
+    Re-filter or re-sort the results of a completed search without searching
+    again (see refinement). Criteria are those of the search, plus optional
+    'filters' (parameter overrides), 'filter_variant' and 'sort'.
+    """
+    if not scheduling.should_run(criteria, reply_channel):
+        return
+
+    check_in = datetime.strptime(criteria['checkIn'], '%Y-%m-%d')
+    check_out = datetime.strptime(criteria['checkOut'], '%Y-%m-%d')
+    criteria['check_in_range'] = date_range(check_in, check_out - DateOffset(days=1))
+
+    outbound_message = create_outbound_message(criteria)
+    results = None
+
+    try:
+        unquote_place(criteria)
+
+        filter_parameters = refinement.get_filter_parameters(
+            criteria.get('filter_variant'), criteria.get('filters'))
+        sort = refinement.get_sort(criteria.get('sort'))
+
+        result_key = utils.create_result_key(criteria)
+        refined_result_key, outbound_message, results = refine_results(
+            criteria, result_key, outbound_message, filter_parameters, sort)
+
+    except refinement.CandidatesExpired:
+        # The client should search again. The shared result set may be fresh
+        # but without candidates (e.g. filled by a prefetch), so it is no
+        # longer reused, and the search is run again with its candidates
+        coalesce.expire(utils.create_result_key(criteria))
+        outbound_message['status'] = '410'
+
+    except (ValueError, TypeError):
+        outbound_message['status'] = '400'
+
+    except Exception:
+        outbound_message['status'] = '500'
+
+        exception_type, _, exception_traceback = sys.exc_info()
+        logger.error(exception_type)
+        logger.error(pprint.pformat(traceback.format_tb(exception_traceback, limit=4)))
+
+    if outbound_message['status'] == '200':
+        save_result_pointer(criteria, session_key, refined_result_key)
+
+    send_results(reply_channel, outbound_message, results, get_reply_options(criteria))
+
+
+def page_results(criteria, session_key, reply_channel):
+    """
+    Send a page of a completed search's results (protocol 3), optionally
+    narrowed to cost/distance ranges. Criteria are those of the search, plus
+    'page' (from 1), 'page_size' and 'filters' (see pagination.RANGE_FILTERS).
+    Pages come from the session's result set, so follow any refinement.
+    """
+    if not scheduling.should_run(criteria, reply_channel):
+        return
+
+    options = get_reply_options(criteria)
+    message = {'status': '200', 'part': 'page'}
+
+    try:
+        http_session = SessionStore(session_key=session_key)
+        result_key = http_session[get_search_key(criteria)]['result_key']
+
+        stays = pagination.result_set_cache.get(result_key)
+        if stays is None:
+            raise KeyError(result_key)
+
+        results = pagination.filter_results(
+            stays[get_result_fields(stays)], criteria.get('filters'))
+        page, page_number, page_count = pagination.get_page(
+            results, criteria.get('page', 1), options['page_size'])
+
+        message.update({
+            'page': page_number,
+            'page_count': page_count,
+            'page_size': options['page_size'],
+            'result_count': len(results),
+            'stays': encoding.encode_stays(page, options['format']),
+            'hotels': get_hotels(get_hotel_ids(page)),
+        })
+
+    except KeyError:
+        # No result set for this search, or it has expired; search again
+        message['status'] = '410'
+
+    except (ValueError, TypeError):
+        message['status'] = '400'
+
+    except Exception:
+        message['status'] = '500'
+
+        exception_type, _, exception_traceback = sys.exc_info()
+        logger.error(exception_type)
+        logger.error(pprint.pformat(traceback.format_tb(exception_traceback, limit=4)))
+
+    send(reply_channel, message, options['format'])
+
+
+def refine_results(criteria, result_key, outbound_message, filter_parameters, sort=None,
+                   candidates=None):
+    """
+    Returns:
+        tuple: (refined result key, outbound message, results)
+
+    Raises:
+        refinement.CandidatesExpired
+    """
+    refined_result_key, stays = refinement.refine(
+        criteria, result_key, filter_parameters, sort, candidates)
+
+    outbound_message = dict(outbound_message)
+    results = describe_results(stays, outbound_message)
+
+    return refined_result_key, outbound_message, results
+
+
+def create_outbound_message(criteria):
+    return {
+        'status': '200',
+        'currency': criteria['currency'],
+        'currency_symbol': settings.CURRENCY_SYMBOLS[criteria['currency']],
+        'country': criteria['country'],  # Blank if not country search
+        'night_count': len(criteria['check_in_range']),
+    }
+
+
+def unquote_place(criteria):
+    criteria['city'] = unquote(criteria['city'])
+    criteria['county'] = unquote(criteria['county'])
+    criteria['state'] = unquote(criteria['state'])
+    criteria['country'] = unquote(criteria['country'])
+
+
+def get_result_fields(stays):
+    fields_required_on_results_page = FIELDS_REQUIRED_ON_RESULTS_PAGE
+
+    if stays['switch_count'].max() > 0:  # pragma: no cover
+        fields_required_on_results_page = \
+            fields_required_on_results_page + REQUIRED_FIELDS_ONLY_PRESENT_IN_MULTI_NIGHT_SEARCH
+
+    return fields_required_on_results_page
+
+
+def describe_results(stays, outbound_message):
+    """
+    Add the cost and distance ranges of stays to outbound_message.
+
+    Returns:
+        DataFrame: Stays with only the fields required on the results page
+    """
+    night_count = outbound_message['night_count']
+
+    min_stay_cost = stays['stay_cost'].min()
+    max_stay_cost = stays['stay_cost'].max()
+    try:  # pragma: no cover
+        min_switch_distance = int(stays['distance_in_km'].min())
+        max_switch_distance = int(stays['distance_in_km'].max())
+    except ValueError:
+        min_switch_distance = 0
+        max_switch_distance = 0
+    min_nightly_cost = min_stay_cost / night_count
+    max_nightly_cost = max_stay_cost / night_count
+
+    outbound_message['cost_ranges'] = {
+        'minStayCost': floor(min_stay_cost),
+        'maxStayCost': ceil(max_stay_cost),
+        'minNightlyCost': floor(min_nightly_cost),
+        'maxNightlyCost': ceil(max_nightly_cost),
+    }
+
+    outbound_message['distance_ranges'] = {
+        'minDistanceSwitch': min_switch_distance,
+        'maxDistanceSwitch': max_switch_distance,
+    }
+
+    return stays[get_result_fields(stays)]
+
+
+def get_reply_options(criteria):
+    """
+    Presentation options requested by the websocket client. These travel with
+    coalesced waiters, as identical searches may be made by different clients.
+
+    Protocol 1 sends all results in a single message. Protocol 2 streams the
+    top results first, followed by further chunks, then the ranges. See
+    encoding.WIRE_FORMATS for the available formats.
+    """
+    wire_format = criteria.get('format', 'records')
+    if wire_format not in encoding.WIRE_FORMATS:
+        wire_format = 'records'
+
+    # Only variants defined in settings; the switch comes from the page URL
+    filter_variant = criteria.get('filter_variant')
+    if filter_variant not in refinement.get_filter_variants():
+        filter_variant = None
+
+    return {
+        'protocol': int(criteria.get('protocol', 1)),
+        'format': wire_format,
+        'filter_variant': filter_variant,
+        'page_size': pagination.get_page_size(criteria),
+    }
+
+
+def send(reply_channel, message, wire_format='records'):
+    Channel(reply_channel).send(encoding.pack_message(message, wire_format))
+
+
+def send_results(reply_channel, outbound_message, results, options):
+    wire_format = options['format']
+
+    if outbound_message['status'] != '200':
+        send(reply_channel, outbound_message, wire_format)
+        return
+
+    try:
+        if options['protocol'] >= 3:
+            send_first_page(reply_channel, outbound_message, results, options)
+        elif options['protocol'] == 2:
+            stream_results(reply_channel, outbound_message, results, wire_format)
+        else:
+            message = dict(outbound_message)
+            message['stays'] = encoding.encode_stays(results, wire_format)
+            message['hotels'] = get_hotels(get_hotel_ids(results))
+            send(reply_channel, message, wire_format)
+
+    except Exception:
+        exception_type, _, exception_traceback = sys.exc_info()
+        logger.error(exception_type)
+        logger.error(pprint.pformat(traceback.format_tb(exception_traceback, limit=4)))
+
+        send(reply_channel, dict(outbound_message, status='500'), wire_format)
+
+
+def stream_results(reply_channel, outbound_message, results, wire_format):
+    """
+    Send the top results as soon as possible, followed by the remainder in
+    chunks (each with only the hotels not already sent), and finally the
+    cost/distance ranges. Keeps each message well under channel layer limits.
+    """
+    first_chunk_size = getattr(settings, 'RESULTS_FIRST_CHUNK_SIZE', 50)
+    chunk_size = getattr(settings, 'RESULTS_CHUNK_SIZE', 1000)
+
+    range_keys = ['cost_ranges', 'distance_ranges']
+    message = {key: value for key, value in outbound_message.items() if key not in range_keys}
+
+    sent_hotel_ids = set()
+    boundaries = [0] + list(range(first_chunk_size, len(results), chunk_size)) + [len(results)]
+
+    for sequence, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:])):
+        chunk = results.iloc[start:end]
+
+        hotel_ids = [
+            hotel_id for hotel_id in get_hotel_ids(chunk) if hotel_id not in sent_hotel_ids]
+        sent_hotel_ids.update(hotel_ids)
+
+        message.update({
+            'part': 'first' if sequence == 0 else 'chunk',
+            'sequence': sequence,
+            'result_count': len(results),
+            'stays': encoding.encode_stays(chunk, wire_format),
+            'hotels': get_hotels(hotel_ids),
+        })
+        send(reply_channel, message, wire_format)
+
+        # Search-level fields are only needed once
+        message = {'status': '200'}
+
+    send(reply_channel, {
+        'status': '200',
+        'part': 'complete',
+        'sequence': len(boundaries) - 1,
+        'cost_ranges': outbound_message['cost_ranges'],
+        'distance_ranges': outbound_message['distance_ranges'],
+    }, wire_format)
+
+
+def send_first_page(reply_channel, outbound_message, results, options):
+    """
+    Send only the first page of results with the ranges and result count;
+    the client requests further pages with the 'page' action
+    """
+    page, _, page_count = pagination.get_page(results, 1, options['page_size'])
+
+    message = dict(outbound_message)
+    message.update({
+        'part': 'page',
+        'page': 1,
+        'page_count': page_count,
+        'page_size': options['page_size'],
+        'result_count': len(results),
+        'stays': encoding.encode_stays(page, options['format']),
+        'hotels': get_hotels(get_hotel_ids(page)),
+    })
+    send(reply_channel, message, options['format'])
+
+
+def get_hotel_ids(stays):
+    hotel_id_columns = stays.columns.str.contains('hotel_[\d]_id')
+    return melt(stays.loc[:, hotel_id_columns]).dropna()['value'].unique()
+
+
+def get_hotels(hotel_ids):
+    """
+    Returns:
+        dict: Hotel information keyed by hotel_id (as a string)
+    """
+    return hotel_card_cache.get_cards(hotel_ids)
+
+
+def save_result_pointer(criteria, session_key, result_key):
+    """
+    The session only holds a pointer to the result store so that each search
+    doesn't rewrite a multi-megabyte session row
+    """
+    search_key = get_search_key(criteria)
+
+    http_session = SessionStore(session_key=session_key)
+
+    http_session[search_key] = {
+        'result_key': result_key,
+        'timestamp': datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+    http_session.save()
+
+    store.index_session_result(session_key, search_key)
+
+
+def get_search_key(criteria):
+    """
+    Returns:
+        str: Key of the session's pointer to the search's result set
+    """
+    return utils.create_session_key(
+        unquote(criteria['place_name']),
+        criteria['checkIn'],
+        criteria['checkOut'],
+        criteria['occupants'],
+        criteria['latitude'],
+        criteria['longitude'],
+        criteria['currency'],
+    )
+
+
 def log_max_saving(criteria, max_saving, retain_count=5):  # pragma: no cover
     with transaction.atomic():
         LatestSaving.objects.select_for_update().all().update(position=F('position') + 1)
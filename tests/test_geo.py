@@ -0,0 +1,85 @@
+import numpy as np
+from django.test import SimpleTestCase
+from pandas import DataFrame, concat
+
+from apps.search import geo
+
+
+def get_hotels(random, hotel_count, latitude, longitude, spread):
+    return DataFrame({
+        'latitude': latitude + random.uniform(-spread, spread, hotel_count),
+        'longitude': longitude + random.uniform(-spread, spread, hotel_count),
+    })
+
+
+def brute_force_pairs_within(hotels, max_distance_in_km):
+    """
+    Returns:
+        dict: (lower hotel id, higher hotel id) to distance for every pair
+    """
+    hotels = hotels.dropna()
+    hotel_ids = hotels['hotel_id'].values
+    latitudes = hotels['latitude'].values
+    longitudes = hotels['longitude'].values
+
+    pairs = {}
+    for position in range(len(hotels)):
+        distances = geo.haversine_km(
+            latitudes[position], longitudes[position],
+            latitudes[position + 1:], longitudes[position + 1:])
+        for other_position in np.flatnonzero(distances <= max_distance_in_km):
+            hotel_id = hotel_ids[position]
+            other_hotel_id = hotel_ids[position + 1 + other_position]
+            pairs[(min(hotel_id, other_hotel_id), max(hotel_id, other_hotel_id))] = \
+                distances[other_position]
+
+    return pairs
+
+
+class HotelGridTestCase(SimpleTestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+
+        # Spread across the prime meridian, at high latitude and near the
+        # equator, with a dense cluster, identical locations and a hotel
+        # without coordinates
+        hotels = concat([
+            get_hotels(random, 150, 51.5, 0, 0.1),
+            get_hotels(random, 100, 69.6, 18.9, 0.2),
+            get_hotels(random, 100, 1.3, 103.8, 0.05),
+            get_hotels(random, 100, -33.9, 151.2, 0.005),
+            DataFrame({'latitude': [40.7, 40.7, np.nan], 'longitude': [-74.0, -74.0, 2.0]}),
+        ], ignore_index=True)
+        hotels['hotel_id'] = random.permutation(len(hotels)) + 1000
+
+        self.hotels = hotels
+
+    def test_pairs_within(self):
+        for max_distance_in_km in [0.1, 1, 5]:
+            pairs = geo.HotelGrid(self.hotels).pairs_within(max_distance_in_km)
+            expected_pairs = brute_force_pairs_within(self.hotels, max_distance_in_km)
+
+            found_pairs = {
+                (min(hotel_1_id, hotel_2_id), max(hotel_1_id, hotel_2_id)): distance
+                for hotel_1_id, hotel_2_id, distance in pairs[
+                    ['hotel_1_id', 'hotel_2_id', 'distance_in_km']].itertuples(index=False)}
+
+            self.assertEqual(len(found_pairs), len(pairs), 'Pairs should be unique')
+            self.assertEqual(set(found_pairs), set(expected_pairs))
+            for pair, distance in expected_pairs.items():
+                self.assertAlmostEqual(found_pairs[pair], distance)
+
+    def test_pairs_within_few_hotels(self):
+        self.assertEqual(len(geo.HotelGrid(self.hotels.iloc[:1]).pairs_within(5)), 0)
+        self.assertEqual(len(geo.HotelGrid(self.hotels.iloc[:0]).pairs_within(5)), 0)
+
+    def test_has_neighbour_within(self):
+        for max_distance_in_km in [0.1, 1, 5]:
+            has_neighbour = geo.HotelGrid(self.hotels).has_neighbour_within(max_distance_in_km)
+
+            expected_hotel_ids = set()
+            for pair in brute_force_pairs_within(self.hotels, max_distance_in_km):
+                expected_hotel_ids.update(pair)
+
+            self.assertEqual(len(has_neighbour), len(self.hotels.dropna()))
+            self.assertEqual(set(has_neighbour.index[has_neighbour.values]), expected_hotel_ids)
@@ -0,0 +1,93 @@
+import numpy as np
+from django.test import SimpleTestCase, override_settings
+from pandas import DataFrame
+
+from apps.search import pagination
+
+
+class GetPageTestCase(SimpleTestCase):
+    def setUp(self):
+        self.results = DataFrame({'stay_cost': np.arange(10) * 100.0}, index=np.arange(10) + 50)
+
+    def assert_page(self, page, page_size, expected_costs, expected_page, expected_page_count):
+        results, page, page_count = pagination.get_page(self.results, page, page_size)
+
+        self.assertEqual(list(results['stay_cost']), expected_costs)
+        self.assertEqual(page, expected_page)
+        self.assertEqual(page_count, expected_page_count)
+
+    def test_pages(self):
+        self.assert_page(1, 4, [0, 100, 200, 300], 1, 3)
+        self.assert_page(2, 4, [400, 500, 600, 700], 2, 3)
+        self.assert_page(3, 4, [800, 900], 3, 3)
+
+    def test_page_size_dividing_result_count(self):
+        self.assert_page(2, 5, [500, 600, 700, 800, 900], 2, 2)
+
+    def test_page_size_above_result_count(self):
+        self.assert_page(1, 50, list(np.arange(10) * 100.0), 1, 1)
+
+    def test_out_of_range_pages(self):
+        self.assert_page(4, 4, [800, 900], 3, 3)
+        self.assert_page(0, 4, [0, 100, 200, 300], 1, 3)
+        self.assert_page(-1, 4, [0, 100, 200, 300], 1, 3)
+
+    def test_page_as_string(self):
+        self.assert_page('2', 4, [400, 500, 600, 700], 2, 3)
+
+    def test_no_results(self):
+        self.results = self.results.iloc[:0]
+
+        self.assert_page(1, 4, [], 1, 1)
+        self.assert_page(3, 4, [], 1, 1)
+
+
+class FilterResultsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.results = DataFrame({
+            'rounded_stay_cost': [100.0, 200.0, 300.0, 400.0],
+            'distance_in_km': [np.nan, 0.5, 1.0, 2.0],
+        })
+
+    def assert_costs(self, filters, expected_costs):
+        results = pagination.filter_results(self.results, filters)
+
+        self.assertEqual(list(results['rounded_stay_cost']), expected_costs)
+
+    def test_no_filters(self):
+        self.assert_costs(None, [100, 200, 300, 400])
+        self.assert_costs({}, [100, 200, 300, 400])
+
+    def test_inclusive_bounds(self):
+        self.assert_costs({'minStayCost': 200, 'maxStayCost': 300}, [200, 300])
+
+    def test_values_as_strings(self):
+        self.assert_costs({'minStayCost': '150.5'}, [200, 300, 400])
+
+    def test_missing_values_are_kept(self):
+        self.assert_costs({'minDistanceSwitch': 1}, [100, 300, 400])
+        self.assert_costs({'maxDistanceSwitch': 0.1}, [100])
+
+    def test_missing_fields_are_ignored(self):
+        self.assert_costs({'maxNightlyCost': 10}, [100, 200, 300, 400])
+
+    def test_none_is_ignored(self):
+        self.assert_costs({'minStayCost': None, 'maxStayCost': 300}, [100, 200, 300])
+
+    def test_empty_range(self):
+        self.assert_costs({'minStayCost': 300, 'maxStayCost': 200}, [])
+
+    def test_unknown_filter(self):
+        with self.assertRaises(ValueError):
+            pagination.filter_results(self.results, {'maxRating': 5})
+
+
+class GetPageSizeTestCase(SimpleTestCase):
+    @override_settings(RESULTS_PAGE_SIZE=50, RESULTS_MAX_PAGE_SIZE=200)
+    def test_page_size(self):
+        self.assertEqual(pagination.get_page_size({}), 50)
+        self.assertEqual(pagination.get_page_size({'page_size': None}), 50)
+        self.assertEqual(pagination.get_page_size({'page_size': 'many'}), 50)
+        self.assertEqual(pagination.get_page_size({'page_size': '20'}), 20)
+        self.assertEqual(pagination.get_page_size({'page_size': 1000}), 200)
+        self.assertEqual(pagination.get_page_size({'page_size': -5}), 1)
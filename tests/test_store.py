@@ -0,0 +1,67 @@
+import datetime
+
+import numpy as np
+from django.test import SimpleTestCase
+from pandas import Categorical, DataFrame, Index, NaT, RangeIndex, Timestamp
+from pandas.util.testing import assert_frame_equal
+
+from apps.search import store
+
+
+class PackFrameTestCase(SimpleTestCase):
+    def assert_round_trip(self, frame):
+        assert_frame_equal(store.unpack_frame(store.pack_frame(frame)), frame)
+
+    def test_numeric_and_boolean_dtypes(self):
+        self.assert_round_trip(DataFrame({
+            'hotel_id': np.array([1, 2, 3], dtype=np.int32),
+            'night_count': np.array([1, 2, 3], dtype=np.int16),
+            'stay_count': np.array([1, 2, 3], dtype=np.int64),
+            'stay_cost': np.array([1.5, np.nan, 3.25], dtype=np.float32),
+            'distance_in_km': [0.1, None, 2.0],
+            'restricted': [True, False, True],
+        }, columns=['hotel_id', 'night_count', 'stay_count', 'stay_cost', 'distance_in_km',
+                    'restricted']))
+
+    def test_object_columns(self):
+        self.assert_round_trip(DataFrame({
+            'room_code': ['DBL', None, 'TWN'],
+            'rate_key': ['a|b', 'c|d', ''],
+            'mixed': [1, 'two', 3.0],
+        }, columns=['room_code', 'rate_key', 'mixed']))
+
+    def test_categoricals(self):
+        self.assert_round_trip(DataFrame({
+            'board_code': Categorical(['BB', 'RO', 'BB', None]),
+            'review_tier': Categorical(
+                ['good', 'excellent', 'good', 'good'],
+                categories=['good', 'excellent'], ordered=True),
+            'star_rating': Categorical([3, 4, 3, 5]),
+        }, columns=['board_code', 'review_tier', 'star_rating']))
+
+    def test_dates(self):
+        self.assert_round_trip(DataFrame({
+            'check_in': np.array(['2017-05-05', 'NaT', '2017-05-07'], dtype='datetime64[ns]'),
+            'check_in_date': [datetime.date(2017, 5, 5), None, datetime.date(2017, 5, 7)],
+            'cancellation_deadline': [
+                Timestamp('2017-05-01 12:00'), NaT, datetime.datetime(2017, 5, 3, 18, 30)],
+        }, columns=['check_in', 'check_in_date', 'cancellation_deadline']))
+
+    def test_non_default_indexes(self):
+        values = {'stay_cost': [1.0, 2.0, 3.0]}
+
+        self.assert_round_trip(DataFrame(values, index=RangeIndex(5, 8)))
+        self.assert_round_trip(DataFrame(values, index=RangeIndex(0, 6, 2)))
+        self.assert_round_trip(DataFrame(values, index=[7, 3, 7]))
+        self.assert_round_trip(DataFrame(values, index=Index(['a', 'b', 'c'])))
+
+    def test_duplicate_and_non_string_column_names(self):
+        frame = DataFrame([[1, 2.0, 'a'], [3, 4.0, 'b']], columns=['cost', 'cost', 0])
+
+        self.assert_round_trip(frame)
+
+    def test_empty_frame(self):
+        self.assert_round_trip(DataFrame({
+            'hotel_id': np.array([], dtype=np.int32),
+            'stay_cost': np.array([], dtype=np.float64),
+        }, columns=['hotel_id', 'stay_cost']))
@@ -0,0 +1,92 @@
+import numpy as np
+from django.test import SimpleTestCase
+from pandas import DataFrame, concat
+from pandas.util.testing import assert_frame_equal
+
+from apps.search.management.commands.summary_stats import select_scenario_stays
+
+
+GROUPING_COLUMNS = ['primary_star_rating', 'min_review_tier']
+
+
+def select_scenario_stays_in_four_passes(stays, grouping_columns):
+    """
+    The selection summary_stats made before select_scenario_stays
+    """
+    stays = stays.sort_values('stay_cost', kind='mergesort')
+    unrestricted_low_cost_stays = stays.groupby(grouping_columns).nth(0)
+    unrestricted_low_cost_stays['restricted'] = False
+
+    stays = stays.sort_values('cost_per_quality_unit', kind='mergesort')
+    unrestricted_best_value_stays = stays.groupby(grouping_columns).nth(0)
+    unrestricted_best_value_stays['restricted'] = False
+
+    stays = stays[stays['entire_stay_cost_1'].notnull() & stays['entire_stay_cost_2'].notnull()]
+
+    stays = stays.sort_values('stay_cost', kind='mergesort')
+    restricted_low_cost_stays = stays.groupby(grouping_columns).nth(0)
+    restricted_low_cost_stays['restricted'] = True
+
+    stays = stays.sort_values('cost_per_quality_unit', kind='mergesort')
+    restricted_best_value_stays = stays.groupby(grouping_columns).nth(0)
+    restricted_best_value_stays['restricted'] = True
+
+    stays = concat([
+        unrestricted_low_cost_stays,
+        unrestricted_best_value_stays,
+        restricted_low_cost_stays,
+        restricted_best_value_stays, ])
+
+    return stays.reset_index().drop_duplicates()
+
+
+def sort_rows(stays):
+    return stays.sort_values(list(stays.columns)).reset_index(drop=True)
+
+
+class SelectScenarioStaysTestCase(SimpleTestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        stay_count = 60
+
+        # Distinct costs, so that both selections agree on ties
+        self.stays = DataFrame({
+            'primary_star_rating': random.choice([3, 4, 5], stay_count),
+            'min_review_tier': random.choice([1, 2], stay_count),
+            'hotel_1_id': np.arange(stay_count),
+            'stay_cost': random.permutation(stay_count) * 10.0 + 100,
+            'cost_per_quality_unit': random.permutation(stay_count) + 0.5,
+            'entire_stay_cost_1': np.where(random.rand(stay_count) < 0.3, np.nan, 500.0),
+            'entire_stay_cost_2': np.where(random.rand(stay_count) < 0.3, np.nan, 600.0),
+        }, columns=GROUPING_COLUMNS + [
+            'hotel_1_id', 'stay_cost', 'cost_per_quality_unit', 'entire_stay_cost_1',
+            'entire_stay_cost_2'])
+
+        # A group without any switch with both benchmarks
+        group = (self.stays['primary_star_rating'] == 5) & (self.stays['min_review_tier'] == 2)
+        self.stays.loc[group, 'entire_stay_cost_1'] = np.nan
+
+    def assert_same_selection(self, stays, grouping_columns=GROUPING_COLUMNS):
+        expected = select_scenario_stays_in_four_passes(stays, grouping_columns)
+        selected = select_scenario_stays(stays, grouping_columns)
+
+        assert_frame_equal(sort_rows(selected), sort_rows(expected))
+
+    def test_matches_four_pass_selection(self):
+        self.assert_same_selection(self.stays)
+
+    def test_ignores_index(self):
+        self.assert_same_selection(self.stays.set_index(self.stays.index * 3 + 7))
+
+    def test_single_grouping_column(self):
+        self.assert_same_selection(self.stays, ['primary_star_rating'])
+
+    def test_no_switches_with_both_benchmarks(self):
+        selected = select_scenario_stays(
+            self.stays.assign(entire_stay_cost_2=np.nan), GROUPING_COLUMNS)
+
+        # Unrestricted selections don't depend on the benchmarks
+        expected = select_scenario_stays_in_four_passes(self.stays, GROUPING_COLUMNS)
+        expected = expected[~expected['restricted']].assign(entire_stay_cost_2=np.nan)
+
+        assert_frame_equal(sort_rows(selected), sort_rows(expected.drop_duplicates()))
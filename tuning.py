@@ -0,0 +1,223 @@
+"""
+Density-aware limits for switch construction.
+
+Switch candidates grow with the square of local hotel density, so a distance
+that suits most cities is intractable in the densest ones. Hotels are counted
+per grid cell (see geo), and for each region of cells the number of hotel
+pairs within each candidate switch distance is estimated from the cells
+around it. The largest distance keeping the estimate within
+SWITCH_CANDIDATE_BUDGET is used, and the review tier limit is tightened
+whenever the distance is reduced.
+
+Only the limits of regions dense enough to be restricted are kept, so the
+table shared via the Django cache and held by each worker stays small. It
+changes slowly, so it is rebuilt periodically with the build_hotel_density
+command (and after changing the tuning settings) rather than on every hotel
+change. If it is missing, searches use the tightest limits while a search
+worker rebuilds it, so run the command as part of each deploy.
+"""
+import logging
+import math
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from pandas import DataFrame
+
+from apps.metadata.models import Hotel
+from apps.search import geo, scheduling
+
+
+logger = logging.getLogger(__name__)
+
+DENSITY_TABLE_KEY = 'hotel_density_table'
+
+CELL_SIZE_IN_KM = 1
+
+# Cells per side of the regions limits are tuned for
+REGION_SIZE_IN_CELLS = 5
+
+
+def get_candidate_budget():
+    return getattr(settings, 'SWITCH_CANDIDATE_BUDGET', 500000)
+
+
+def get_switch_distances():
+    """
+    Returns:
+        list: Switch distances to consider, largest first. The default
+        distance may only be exceeded up to TUNING_MAX_SWITCH_DISTANCE_IN_KM
+    """
+    default_distance = settings.MAX_SWITCH_DISTANCE_IN_KM
+    max_distance = getattr(settings, 'TUNING_MAX_SWITCH_DISTANCE_IN_KM', default_distance)
+    distances = getattr(settings, 'TUNING_SWITCH_DISTANCES_IN_KM', (1, 2, 3, 5, 10, 15, 20))
+
+    return sorted(set(d for d in distances if d <= max_distance) | {default_distance},
+                  reverse=True)
+
+
+def get_conservative_limits():
+    """
+    Returns:
+        tuple: The tightest tuned limits, for use when densities are unknown,
+        so that no city is searched with limits too wide for its density
+    """
+    return min(get_switch_distances()), min(
+        settings.MAX_REVIEW_TIER_DECREASE,
+        getattr(settings, 'TUNED_MAX_REVIEW_TIER_DECREASE', 0))
+
+
+def estimate_candidate_count(sum_of_squares, latitude, distance_in_km):
+    """
+    Estimate the hotel pairs within distance_in_km of each other among the
+    hotels of some cells. Each hotel sees the density of its own cell over a
+    circle of the switch distance, so the estimate is
+    pi * d^2 / 2 * sum(n^2) / cell area.
+    """
+    # Cells are a fixed number of degrees wide, so narrow towards the poles
+    cell_area = CELL_SIZE_IN_KM ** 2 * max(math.cos(math.radians(latitude)), 0.01)
+
+    return math.pi * distance_in_km ** 2 / 2 * sum_of_squares / cell_area
+
+
+def get_limits(sum_of_squares, latitude, budget, distances):
+    """
+    Args:
+        distances (list): From get_switch_distances
+
+    Returns:
+        tuple: (max_switch_distance_in_km, max_review_tier_decrease)
+    """
+    estimates = [estimate_candidate_count(sum_of_squares, latitude, d) for d in distances]
+    distance, estimate = next(
+        ((d, e) for d, e in zip(distances, estimates) if e <= budget),
+        (distances[-1], estimates[-1]))
+
+    max_review_tier_decrease = settings.MAX_REVIEW_TIER_DECREASE
+    if distance < settings.MAX_SWITCH_DISTANCE_IN_KM:
+        max_review_tier_decrease = min(
+            max_review_tier_decrease,
+            getattr(settings, 'TUNED_MAX_REVIEW_TIER_DECREASE', 0))
+
+    logger.debug('{} km, tier decrease {} (~{:.0f} candidates, budget {})'.format(
+        distance, max_review_tier_decrease, estimate, budget))
+
+    return distance, max_review_tier_decrease
+
+
+def get_region(latitude, longitude):
+    (row,), (column,) = geo.get_cells([latitude], [longitude], CELL_SIZE_IN_KM, 0)
+    return row // REGION_SIZE_IN_CELLS, column // REGION_SIZE_IN_CELLS
+
+
+def get_region_latitude(region_row):
+    # Furthest from the equator, where cells are narrowest
+    latitude_step = CELL_SIZE_IN_KM / geo.KM_PER_DEGREE_OF_LATITUDE * REGION_SIZE_IN_CELLS
+    return max(abs(region_row * latitude_step), abs((region_row + 1) * latitude_step))
+
+
+def build_density_table():
+    """
+    Count hotels per grid cell, tune the limits of each region from the
+    cells within TUNING_SEARCH_RADIUS_IN_KM of it, and share the limits of
+    restricted regions via the Django cache.
+
+    Returns:
+        dict: (max_switch_distance_in_km, max_review_tier_decrease) keyed by
+        (row, column) region, for regions with limits below those of an
+        empty region
+    """
+    start_time = time.time()
+    radius_in_km = getattr(settings, 'TUNING_SEARCH_RADIUS_IN_KM', 25)
+
+    hotels = DataFrame(
+        list(Hotel.objects.exclude(latitude=None).exclude(longitude=None)
+             .values_list('latitude', 'longitude').iterator()),
+        columns=['latitude', 'longitude']).astype(float)
+
+    rows, columns = geo.get_cells(hotels['latitude'], hotels['longitude'], CELL_SIZE_IN_KM, 0)
+    counts = DataFrame({'row': rows, 'column': columns}).groupby(['row', 'column']).size()
+
+    # Squared cell counts summed per region, then spread over every region
+    # within the radius, so each region's sum is computed once
+    region_squares = defaultdict(int)
+    for (row, column), count in counts.items():
+        region = row // REGION_SIZE_IN_CELLS, column // REGION_SIZE_IN_CELLS
+        region_squares[region] += int(count) ** 2
+
+    region_size_in_km = CELL_SIZE_IN_KM * REGION_SIZE_IN_CELLS
+    row_span = int(math.ceil(radius_in_km / region_size_in_km))
+
+    neighbourhood_squares = defaultdict(int)
+    for (region_row, region_column), squares in region_squares.items():
+        longitude_scale = max(math.cos(math.radians(get_region_latitude(region_row))), 0.01)
+        column_span = int(math.ceil(radius_in_km / (region_size_in_km * longitude_scale)))
+        for r in range(region_row - row_span, region_row + row_span + 1):
+            for c in range(region_column - column_span, region_column + column_span + 1):
+                neighbourhood_squares[r, c] += squares
+
+    budget = get_candidate_budget()
+    distances = get_switch_distances()
+    unrestricted_limits = get_limits(0, 0, budget, distances)
+
+    limits = {}
+    for (region_row, region_column), squares in neighbourhood_squares.items():
+        latitude = get_region_latitude(region_row)
+        if estimate_candidate_count(squares, latitude, distances[0]) <= budget:
+            continue
+        region_limits = get_limits(squares, latitude, budget, distances)
+        if region_limits != unrestricted_limits:
+            limits[region_row, region_column] = region_limits
+
+    cache.set(DENSITY_TABLE_KEY, {'limits': limits, 'built_at': time.time()}, None)
+    logger.info('Built hotel density table of {} restricted regions from {} hotels '
+                'in {:.1f}s'.format(len(limits), len(hotels), time.time() - start_time))
+
+    return limits
+
+
+class DensityTable(object):
+    def __init__(self):
+        self.limits = None
+
+    def check_validity(self):
+        ttl = getattr(settings, 'HOTEL_DENSITY_TABLE_TTL', 3600)
+
+        if self.limits is None or time.time() - self.loaded_at > ttl:
+            table = cache.get(DENSITY_TABLE_KEY)
+            self.limits = table['limits'] if table is not None else None
+            self.loaded_at = time.time()
+
+            # Never built on the search path; a worker builds it meanwhile
+            if self.limits is None:
+                scheduling.enqueue_maintenance(build_density_table)
+
+    def preload(self):
+        self.limits = None
+        self.check_validity()
+
+    def get_limits(self, latitude, longitude):
+        """
+        Returns:
+            tuple: (max_switch_distance_in_km, max_review_tier_decrease)
+        """
+        self.check_validity()
+
+        if self.limits is None:
+            logger.warning('Hotel density table missing; using the tightest switch limits')
+            return get_conservative_limits()
+
+        latitude, longitude = float(latitude), float(longitude)
+        region_limits = self.limits.get(get_region(latitude, longitude))
+        if region_limits is None:  # Not dense enough to be restricted
+            region_limits = get_limits(0, 0, get_candidate_budget(), get_switch_distances())
+        distance, max_review_tier_decrease = region_limits
+
+        logger.info('Switch limits for ({}, {}): {} km, tier decrease {}'.format(
+            latitude, longitude, distance, max_review_tier_decrease))
+
+        return distance, max_review_tier_decrease
+
+
+density_table = DensityTable()
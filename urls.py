@@ -8,6 +8,7 @@ app_name = 'search'
 urlpatterns = [
     url(r'^$', views.Inputs.as_view(), name='inputs'),
     url(r'^offer/$', views.Inputs.as_view(), name='inputs'),
+    url(r'^metrics/$', views.Metrics.as_view(), name='metrics'),
     # Check-in/-out expressed as YYYY-MM-DD
     # Lat/long rounded to 4dp; may include leading '-'
     url(r'^(?P<place_name>[^/]*)/'
@@ -1,14 +1,13 @@
 import logging
 from collections import OrderedDict
+from urllib.request import unquote
 
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
-from django.conf import settings
-from django.db.models import Count
 from django.core.cache import cache
-from pandas import DataFrame
 
 from apps.search.models import EmergencyModal
 from apps.metadata.models import Hotel
+from apps.search.suggestions import suggested_cities
 
 
 logger = logging.getLogger(__name__)
@@ -30,22 +29,59 @@ def get_emergency_modal():  # pragma: no cover
         return None
 
 
-def log_size(df, descriptor):
+def log_size(df, descriptor, sample_size=1000):
     """
     Log size of DataFrames at INFO level. See pandas FAQs for more explanation:
     http://pandas.pydata.org/pandas-docs/stable/faq.html
 
     Primarily interested in order of magnitude, so not worried about base-10 vs.
-    base-2 when converting to megabytes.
+    base-2 when converting to megabytes. Deep introspection walks every Python
+    object, so by default object columns are estimated from an evenly spaced
+    sample of rows. Exact measurement is used when DEBUG logging is enabled.
 
     Args:
         df (DataFrame)
         descriptor (str): E.g. name of df, or 'initial output'
+        sample_size (int): Rows sampled to estimate object column sizes
     """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    if logger.isEnabledFor(logging.DEBUG):
+        size = df.memory_usage(deep=True).sum()
+        method = 'exact'
+    else:
+        size = estimate_memory_usage(df, sample_size)
+        method = 'estimate'
+
     descriptor = 'Size of {}:'.format(descriptor)
-    logger.info('{:45} {:>5.1f}Mb'.format(
-        descriptor,
-        df.memory_usage(deep=True).sum() / 1000000),)
+    logger.info('{:45} {:>5.1f}Mb ({})'.format(descriptor, size / 1000000, method))
+
+
+def estimate_memory_usage(df, sample_size=1000):
+    """
+    Shallow memory usage is exact for numeric and categorical columns. Object
+    columns add the size of their Python objects, extrapolated from a sample.
+
+    Returns:
+        float: Estimated size in bytes
+    """
+    size = df.memory_usage(deep=False).sum()
+
+    object_columns = df.select_dtypes(include=['object']).columns
+    row_count = len(df)
+
+    if len(object_columns) == 0 or row_count == 0:
+        return size
+
+    step = max(row_count // sample_size, 1)
+    sample = df[object_columns].iloc[::step]
+
+    object_size = (
+        sample.memory_usage(deep=True, index=False).sum() -
+        sample.memory_usage(deep=False, index=False).sum())
+
+    return size + object_size * row_count / len(sample)
 
 
 def create_session_key(place_name, check_in, check_out, occupants, latitude, longitude, currency):
@@ -64,64 +100,37 @@ def create_session_key(place_name, check_in, check_out, occupants, latitude, lon
     return '|'.join(dimensions.values())
 
 
-def get_suggested_cities():  # pragma: no cover
-    countries = (
-        Hotel.objects.values('iso_alpha_2_country_code')
-        .annotate(hotel_count=Count('hotel_id')))
-
+def create_result_key(criteria):
     """
-    states = (
-        Hotel.objects.values('iso_alpha_2_country_code', 'state')
-        .annotate(hotel_count=Count('hotel_id')))
-
-    counties = (
-        Hotel.objects.values('iso_alpha_2_country_code', 'state', 'county')
-        .annotate(hotel_count=Count('hotel_id')))
+    We use the key to store and share result sets. Rates differ by source
+    market, and country/state/county/city searches for the same place return
+    different hotels, so these are included alongside the session key
+    dimensions.
     """
+    session_key = create_session_key(
+        unquote(criteria['place_name']),
+        criteria['checkIn'],
+        criteria['checkOut'],
+        criteria['occupants'],
+        criteria['latitude'],
+        criteria['longitude'],
+        criteria['currency'],
+    )
+    dimensions = OrderedDict([
+        ('session_key', session_key),
+        ('country', criteria['country']),
+        ('state', criteria['state']),
+        ('county', criteria['county']),
+        ('city', criteria['city']),
+        ('source_market', criteria['source_market']),
+    ])
+    return '|'.join(dimensions.values())
 
-    # We don't want to construct switches for too many hotels at once. The
-    # technical limit is 2,000 per request and might work if we constrain to
-    # only switches within the same city.
-    oversize_countries = (
-        countries
-        .filter(hotel_count__gte=settings.MAXIMUM_COUNTRY_HOTEL_COUNT)
-        .values_list('iso_alpha_2_country_code', flat=True))
 
+def get_suggested_cities(level='country'):  # pragma: no cover
     """
-    oversize_states = (
-        states
-        .filter(hotel_count__gte=settings.MAXIMUM_COUNTRY_HOTEL_COUNT)
-        .values_list('iso_alpha_2_country_code', flat=True))
-
-    oversize_counties = (
-        counties
-        .filter(hotel_count__gte=settings.MAXIMUM_COUNTRY_HOTEL_COUNT)
-        .values_list('iso_alpha_2_country_code', flat=True))
+    Returns:
+        dict: Largest cities of each place with too many hotels to search at
+        once, served from memory (see suggestions)
     """
-
-    # TODO: Extend country methodology to state + county
-    country_city_counts = (
-        Hotel.objects.filter(iso_alpha_2_country_code__in=oversize_countries)
-        .values('iso_alpha_2_country_code', 'city')
-        .annotate(hotel_count=Count('hotel_id')))
-
-    country_city_counts = DataFrame(list(country_city_counts))
-    country_city_counts.sort_values(
-        ['iso_alpha_2_country_code', 'hotel_count'], ascending=False, inplace=True)
-
-    suggested_cities = (
-        country_city_counts
-        .groupby('iso_alpha_2_country_code')
-        .nth(list(range(settings.SUGGESTED_CITY_COUNT))))
-
-    suggested_cities.reset_index(inplace=True)
-
-    suggested_cities['rank'] = (
-        suggested_cities.groupby('iso_alpha_2_country_code')['hotel_count']
-        .rank(method='first', ascending=False)
-        .astype('int'))
-
-    suggested_cities = suggested_cities.pivot(
-        index='iso_alpha_2_country_code', columns='rank', values='city')
-
-    return suggested_cities.to_dict('index')
+    return suggested_cities.get(level)
@@ -1,18 +1,19 @@
 from collections import OrderedDict
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404, HttpResponse
 from django.shortcuts import redirect
-from django.views.generic import TemplateView
+from django.views.generic import TemplateView, View
 import logging
-from pandas import DataFrame, DateOffset, datetime, date_range, merge, read_json
+from pandas import DataFrame, DateOffset, datetime, date_range
 
 from apps.accounts import utils as account_utils
-import apps.apis.tripadvisor.api as tripadvisor
-from apps.apis.models import HotelbedsRoom, HotelbedsBoard, HotelbedsFacility
 from apps.landing_pages.models import Event, Destination
 from apps.metadata.models import Hotel
-from apps.search import mixins, utils
+from apps.search import metrics, mixins, prefetch, scheduling, store, utils
 from apps.search.models import LatestSaving
+from apps.search.reference import reference_data
+from apps.search.reviews import review_fetcher
 
 
 logger = logging.getLogger(__name__)
@@ -198,8 +199,16 @@ class StayDetail(ResultView):
         results_key = '|'.join(results_key.values())
 
         try:
-            stays = self.request.session.get(results_key)['stays']
-        except TypeError:
+            result_key = self.request.session.get(results_key)['result_key']
+            self.stay = store.load_stay(
+                result_key,
+                kwargs['hotel_1_id'],
+                kwargs.get('hotel_2_id', 0),
+                kwargs.get('check_in_2'))
+        except (TypeError, KeyError):
+            self.stay = None
+
+        if self.stay is None:
             # No stays in session due to expired results or link-sharing.
             # TODO: Consider loading results page directly, but remember that
             # there is no access at this point to the additional location type
@@ -208,97 +217,45 @@ class StayDetail(ResultView):
             # the requested search_criteria)
             return redirect('search:inputs')
 
-        self.stays = read_json(
-            stays,
-            convert_dates=[
-                'cancellation_deadline',
-                'cancellation_deadline_1',
-                'cancellation_deadline_2',
-            ]
-        )
-
         return super(StayDetail, self).dispatch(request, *args, **kwargs)
 
     def get_context_data(self, **kwargs):
         context = super(StayDetail, self).get_context_data(**kwargs)
-        stays = self.stays
+        stay = self.stay
 
         hotel_1_id = int(kwargs['hotel_1_id'])
         hotel_2_id = int(kwargs.get('hotel_2_id', 0))
-        check_in_2 = self.kwargs.get('check_in_2')
-
-        query = 'hotel_1_id == @hotel_1_id'
-
-        max_switch_count = stays['switch_count'].max()
-
-        if max_switch_count > 0:  # pragma: no cover
-            query = query + \
-                '& ((hotel_2_id == @hotel_2_id & check_in_2 == @check_in_2) \
-                     | (@hotel_2_id == 0 & switch_count == 0))'
-
-        stay = stays.query(query)
-
-        check_out_1 = check_in_2 = datetime.strptime(stay['check_out_1'].values[0], '%Y-%m-%d')
-
-        stay = stay.to_dict('records')[0]
-
-        facilities = HotelbedsFacility.objects.all().iterator()
-
-        facilities = [{
-            'code': facility.code,
-            'group': facility.group,
-            'description': facility.description,
-        } for facility in facilities]
 
-        facilities = DataFrame(facilities)
+        check_out_1 = check_in_2 = datetime.strptime(stay['check_out_1'], '%Y-%m-%d')
 
-        hotel = Hotel.objects.get(hotel_id=hotel_1_id)
-        hotels = [hotel]
+        hotel_ids = [hotel_1_id]
+        room_codes = [stay['room_type_1']]
+        board_codes = [stay['board_1']]
 
-        try:  # pragma: no cover
-            hotel_facilities = DataFrame(hotel.facilities)
-            hotel_facilities.query('available == True', inplace=True)
-            hotel_facilities = merge(hotel_facilities, facilities, on=['code', 'group'])
-
-            hotel_facility_lists = [hotel_facilities.to_dict('records')]
-        except Exception:
-            hotel_facility_lists = []
-
-        rooms = [HotelbedsRoom.objects.get(code=stay['room_type_1']).description]
-        boards = [HotelbedsBoard.objects.get(code=stay['board_1']).description]
         if hotel_2_id > 0:  # pragma: no cover
-            hotel = Hotel.objects.get(hotel_id=hotel_2_id)
-            hotels.append(hotel)
+            hotel_ids.append(hotel_2_id)
+            room_codes.append(stay['room_type_2'])
+            board_codes.append(stay['board_2'])
 
-            try:  # pragma: no cover
-                hotel_facilities = DataFrame(hotel.facilities)
-                hotel_facilities.query('available == True', inplace=True)
-                hotel_facilities = merge(hotel_facilities, facilities, on=['code', 'group'])
+        # Both hotels in a single query
+        hotels = Hotel.objects.filter(hotel_id__in=hotel_ids)
+        hotels = {hotel.hotel_id: hotel for hotel in hotels}
+        hotels = [hotels[hotel_id] for hotel_id in hotel_ids]
 
-                hotel_facility_lists.append(hotel_facilities.to_dict('records'))
-            except Exception:
-                pass
-
-            rooms.append(HotelbedsRoom.objects.get(code=stay['room_type_2']).description)
-            boards.append(HotelbedsBoard.objects.get(code=stay['board_2']).description)
+        rooms = [reference_data.get_room_description(code) for code in room_codes]
+        boards = [reference_data.get_board_description(code) for code in board_codes]
 
         # Stored separately for passing to JS
         galleria_images = self.parse_hotel_images(hotels)
 
         try:  # pragma: no cover
-            tripadvisor_reviews = [tripadvisor.get_tripadvisor_review(hotel.tripadvisor.tripadvisor)
-                                   for hotel in hotels]
+            tripadvisor_ids = [hotel.tripadvisor.tripadvisor for hotel in hotels]
+            tripadvisor_reviews = review_fetcher.get_reviews(tripadvisor_ids)
         except AttributeError:
             tripadvisor_reviews = []
 
-        facilities = {}
-        for idx, hotel in enumerate(hotels):
-            lst = []
-            try:
-                lst = hotel_facility_lists[idx]
-            except IndexError:
-                pass
-            facilities[hotel.hotel_id] = lst
+        facilities = {
+            hotel.hotel_id: reference_data.get_hotel_facilities(hotel) for hotel in hotels}
 
         context.update({
             'stay': stay,
@@ -336,3 +293,18 @@ class StayDetail(ResultView):
             galleria_images.append(images[['image', 'thumb']].to_dict('records'))
 
         return galleria_images
+
+
+class Metrics(View):
+    """
+    Search metrics in the Prometheus text format, for scraping from within
+    our own network only
+    """
+    def get(self, request, *args, **kwargs):
+        allowed_ips = metrics.get_allowed_ips()
+        if not metrics.metrics_enabled() or request.META.get('REMOTE_ADDR') not in allowed_ips:
+            raise Http404
+
+        return HttpResponse(
+            metrics.render() + scheduling.render_metrics() + prefetch.render_metrics(),
+            content_type='text/plain; version=0.0.4')
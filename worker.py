@@ -0,0 +1,77 @@
+"""
+Long-lived search workers.
+
+RQ's default worker forks a fresh work horse per job, so every search pays
+for imports, Django setup and cold caches. Instead, the pool's parent process
+preloads everything once and forks children that run jobs in-process. Each
+child exits after a bounded number of jobs to contain memory growth, and is
+replaced by a fresh fork of the warm parent.
+"""
+import logging
+
+from django.conf import settings
+from rq import Queue, SimpleWorker
+
+from apps.search import coalesce
+from apps.search import tasks  # noqa - sets up Django, imports pandas and algorithm modules
+from apps.search.hotel_cards import hotel_card_cache
+from apps.search.tuning import density_table
+
+
+logger = logging.getLogger(__name__)
+
+
+def preload():
+    """
+    Warm everything that would otherwise be loaded per job. Importing tasks
+    has already set up Django and imported pandas and the algorithm modules.
+    """
+    hotel_card_cache.preload()
+    density_table.preload()
+
+
+def refresh():
+    """
+    Bring the preloaded caches up to date before forking a replacement
+    child, so that children never start with caches past their TTL and
+    reload them within a search.
+    """
+    hotel_card_cache.check_validity()
+    density_table.check_validity()
+
+
+def rescue_orphaned_waiters():
+    """
+    Re-run the searches of anyone left waiting on a search whose worker died
+    """
+    rescued_count = coalesce.rescue_orphaned_waiters(tasks.execute_search)
+    if rescued_count:
+        logger.warning('Re-ran {} orphaned searches'.format(rescued_count))
+
+
+class RecyclingWorker(SimpleWorker):
+    """
+    Runs jobs in its own process, stopping after max_jobs jobs
+    """
+    def __init__(self, *args, **kwargs):
+        self.max_jobs = kwargs.pop('max_jobs')
+        self.job_count = 0
+        super(RecyclingWorker, self).__init__(*args, **kwargs)
+
+    def execute_job(self, *args, **kwargs):
+        result = super(RecyclingWorker, self).execute_job(*args, **kwargs)
+
+        self.job_count += 1
+        if self.job_count >= self.max_jobs:
+            logger.info('Recycling worker after {} jobs'.format(self.job_count))
+            # Checked by the work loop before dequeuing the next job
+            self._stop_requested = True
+
+        return result
+
+
+def run_worker(queue_names, max_jobs):
+    connection = settings.REDIS_CONNECTION
+    queues = [Queue(name, connection=connection) for name in queue_names]
+
+    RecyclingWorker(queues, connection=connection, max_jobs=max_jobs).work()